@@ -4,7 +4,7 @@ import webbrowser
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import parse_qs, urlencode
 
-import requests
+from util import SPOTIFY_TOKEN_FILE, http_post
 
 
 class OAuthHandler(BaseHTTPRequestHandler):
@@ -52,7 +52,7 @@ def get_spotify_refresh_token():
     # Exchange authorization code for token
     auth_b64 = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
 
-    response = requests.post(
+    response = http_post(
         "https://accounts.spotify.com/api/token",
         data={
             "grant_type": "authorization_code",
@@ -94,6 +94,8 @@ if __name__ == "__main__":
     try:
         refresh_token = get_spotify_refresh_token()
         update_env_file(refresh_token)
+        # The cached access token belongs to the previous refresh token
+        SPOTIFY_TOKEN_FILE.unlink(missing_ok=True)
         print("Refresh token has been saved in .env file")
     except Exception as e:
         print(f"Error: {e}")
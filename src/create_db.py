@@ -1,11 +1,96 @@
 import argparse
+import hashlib
+import json
 import os
+import re
 import shutil
+import tempfile
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+
+from storage import (
+    compact_history_file,
+    is_compact,
+    iter_history_batches,
+    read_history,
+    save_partitioned_history,
+)
+
+# Data types of the fields in the streaming history JSON files
+EXPORT_DTYPES = {
+    "ts": str,
+    "track_id": "string",
+    "platform": "string",
+    "ms_played": np.int64,
+    "conn_country": "string",
+    "ip_addr_decrypted": "string",
+    "master_metadata_track_name": "string",
+    "master_metadata_album_artist_name": "string",
+    "master_metadata_album_album_name": "string",
+    "spotify_track_uri": "string",
+    "episode_name": "string",
+    "episode_show_name": "string",
+    "spotify_episode_uri": "string",
+    "reason_start": "string",
+    "reason_end": "string",
+    "shuffle": bool,
+    "skipped": bool,
+    "offline": bool,
+    "offline_timestamp": np.int64,
+    "incognito_mode": bool,
+}
+
+# The same data types as an Arrow schema for the arrow JSON reader
+EXPORT_SCHEMA = pa.schema(
+    [
+        (name, {np.int64: pa.int64(), bool: pa.bool_()}.get(dtype, pa.string()))
+        for name, dtype in EXPORT_DTYPES.items()
+    ]
+)
+
+EXPORT_RENAMES = {
+    "ip_addr_decrypted": "ip_addr",
+    "master_metadata_track_name": "track_name",
+    "master_metadata_album_artist_name": "artist_name",
+    "master_metadata_album_album_name": "album_name",
+}
+
+# Comma between two records of a pretty printed JSON array. JSON strings can't contain raw newlines
+# and the records are flat objects, so this never matches inside a record.
+RECORD_SEPARATOR = re.compile(rb"\}\s*,[ \t\r]*\n\s*\{")
+
+# Columns kept by preprocess_df, in output order
+HISTORY_COLUMNS = [
+    "track_id",
+    "ts",
+    "ms_played",
+    "reason_start",
+    "reason_end",
+    "full_play",
+    "conn_country",
+    "platform",
+    "shuffle",
+    "offline",
+    "incognito_mode",
+]
+
+# Columns that identify a play, hashed into a fingerprint for deduplication
+RECORD_KEY_COLUMNS = ["ts", "track_id", "ms_played", "reason_start", "reason_end", "platform"]
+
+# Folder in the Spotify data download that contains the streaming history
+EXPORT_FOLDER = "Spotify Extended Streaming History"
+
+# Rows per batch when merging the per-file runs in streaming mode
+STREAM_BATCH_ROWS = 50_000
 
 
 def extract_spotify_data(zip_path, raw_data_dir):
@@ -19,11 +104,11 @@ def extract_spotify_data(zip_path, raw_data_dir):
 
         # Extract only files from "Spotify Extended Streaming History" folder
         for file in files:
-            if "Spotify Extended Streaming History" in file:
+            if EXPORT_FOLDER in file:
                 zip_ref.extract(file, raw_data_dir)
 
         # Move files from nested folder to raw directory
-        source_dir = raw_data_dir / "Spotify Extended Streaming History"
+        source_dir = raw_data_dir / EXPORT_FOLDER
         if source_dir.exists():
             for file in source_dir.glob("*"):
                 shutil.move(str(file), str(raw_data_dir / file.name))
@@ -31,46 +116,115 @@ def extract_spotify_data(zip_path, raw_data_dir):
             source_dir.rmdir()
 
 
+def list_export_files(input_path):
+    """
+    List the streaming history JSON files of a Spotify data download.
+
+    Args:
+        input_path: Spotify data zip file or a directory with the extracted JSON files
+
+    Returns:
+        list[tuple]: (zip_path, name) pairs, zip_path is None for files in a directory
+    """
+    input_path = Path(input_path)
+    if zipfile.is_zipfile(input_path):
+        with zipfile.ZipFile(input_path, "r") as zip_ref:
+            names = [fn for fn in zip_ref.namelist() if EXPORT_FOLDER in fn and fn.endswith(".json")]
+        return [(input_path, fn) for fn in sorted(names)]
+    return [(None, input_path / fn) for fn in sorted(os.listdir(input_path)) if fn.endswith(".json")]
+
+
+@contextmanager
+def open_export_file(export_file):
+    """Open a file returned by list_export_files in binary mode, zip members are not extracted."""
+    zip_path, name = export_file
+    if zip_path is None:
+        with open(name, "rb") as f:
+            yield f
+    else:
+        with zipfile.ZipFile(zip_path, "r") as zip_ref, zip_ref.open(name) as f:
+            yield f
+
+
+def read_export_file(export_file, backend="arrow"):
+    """
+    Read a file returned by list_export_files into a DataFrame.
+
+    Args:
+        export_file: (zip_path, name) pair from list_export_files
+        backend: "arrow" for the multithreaded arrow JSON reader or "pandas" for pd.read_json.
+            Files that arrow can't parse are read with pandas.
+    """
+    if backend == "arrow":
+        try:
+            with open_export_file(export_file) as f:
+                return read_json_arrow(f)
+        except pa.ArrowInvalid as e:
+            print(f"Arrow could not parse {export_file[1]}, falling back to pandas: {e}")
+    with open_export_file(export_file) as f:
+        return read_json(f)
+
+
 def read_json(path_or_buf):
-    df = pd.read_json(
-        path_or_buf,
-        dtype={
-            "ts": str,
-            "track_id": "string",
-            "platform": "string",
-            "ms_played": np.int64,
-            "conn_country": "string",
-            "ip_addr_decrypted": "string",
-            "master_metadata_track_name": "string",
-            "master_metadata_album_artist_name": "string",
-            "master_metadata_album_album_name": "string",
-            "spotify_track_uri": "string",
-            "episode_name": "string",
-            "episode_show_name": "string",
-            "spotify_episode_uri": "string",
-            "reason_start": "string",
-            "reason_end": "string",
-            "shuffle": bool,
-            "skipped": bool,
-            "offline": bool,
-            "offline_timestamp": np.int64,
-            "incognito_mode": bool,
-        },
-    )
-    df = df.rename(
-        columns={
-            "ip_addr_decrypted": "ip_addr",
-            "master_metadata_track_name": "track_name",
-            "master_metadata_album_artist_name": "artist_name",
-            "master_metadata_album_album_name": "album_name",
-        }
-    )
+    df = pd.read_json(path_or_buf, dtype=EXPORT_DTYPES)
+    df = df.rename(columns=EXPORT_RENAMES)
     return df
 
 
+def read_json_arrow(path_or_buf):
+    """
+    Read a streaming history JSON file with the multithreaded arrow JSON reader.
+
+    The arrow reader expects one object after another instead of a JSON array, so the brackets and
+    the commas between the records are removed first. The explicit schema skips type inference and
+    the columns are created without building a Python object per value.
+    """
+    if hasattr(path_or_buf, "read"):
+        data = path_or_buf.read()
+    else:
+        data = Path(path_or_buf).read_bytes()
+
+    data = data.strip()
+    if data.startswith(b"["):
+        data = RECORD_SEPARATOR.sub(b"}\n{", data[1:-1].strip())
+    if data:
+        table = pa_json.read_json(
+            pa.BufferReader(data),
+            read_options=pa_json.ReadOptions(use_threads=True),
+            parse_options=pa_json.ParseOptions(
+                explicit_schema=EXPORT_SCHEMA,
+                newlines_in_values=True,
+                unexpected_field_behavior="ignore",
+            ),
+        )
+    else:
+        table = EXPORT_SCHEMA.empty_table()
+
+    df = table.to_pandas(types_mapper={pa.string(): pd.StringDtype()}.get)
+    df = df.rename(columns=EXPORT_RENAMES)
+    return df
+
+
+def record_fingerprints(df):
+    """
+    Hash the RECORD_KEY_COLUMNS of every row into a 64-bit fingerprint.
+
+    The key columns are part of the preprocessed data, so the fingerprints of already stored plays can
+    be computed from the parquet files to deduplicate across files and exports.
+
+    Returns:
+        pd.Series: uint64 fingerprint per row
+    """
+    return pd.util.hash_pandas_object(df[RECORD_KEY_COLUMNS], index=False)
+
+
+def drop_duplicate_records(df):
+    """Drop plays with the same fingerprint, keeping the first one."""
+    return df[~record_fingerprints(df).duplicated()]
+
+
 def preprocess_df(df):
-    df = df[df["track_name"] != "None"]
-    df = df.drop_duplicates()
+    df = df[df["track_name"] != "None"].copy()
 
     df["ts"] = pd.to_datetime(df["ts"], format="%Y-%m-%dT%H:%M:%SZ")
 
@@ -89,6 +243,7 @@ def preprocess_df(df):
     )
     df["full_play"] = df["reason_end"] == "trackdone"
     df["track_id"] = df["spotify_track_uri"].str.split(":").str[-1].astype("string")
+    df = drop_duplicate_records(df)
 
     df.sort_values(by="ts", ascending=True, inplace=True)
 
@@ -107,58 +262,343 @@ def preprocess_df(df):
         ]
     )
     # reorder df for a better overview
-    df = df[
-        [
-            "track_id",
-            "ts",
-            "ms_played",
-            "reason_start",
-            "reason_end",
-            "full_play",
-            "conn_country",
-            "platform",
-            "shuffle",
-            "offline",
-            "incognito_mode",
-        ]
-    ]
+    df = df[HISTORY_COLUMNS]
     return df
 
 
-def combine_and_save(input_dir, output_file):
+def load_export_file(export_file, backend="arrow"):
+    """Read and preprocess a single export file, only the compact preprocessed rows are returned."""
+    return preprocess_df(read_export_file(export_file, backend))
+
+
+def save_export_run(export_file, run_file, backend="arrow"):
+    """Read and preprocess a single export file and save it as a ts-sorted parquet run."""
+    load_export_file(export_file, backend).to_parquet(run_file, index=False)
+    return run_file
+
+
+def map_export_files(func, *iterables, workers=1):
+    """Apply func to the export files, in a process pool if more than one worker is used."""
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(func, *iterables))
+    return list(map(func, *iterables))
+
+
+def merge_sorted_runs(run_files, output_file, batch_size=STREAM_BATCH_ROWS):
+    """
+    Merge ts-sorted parquet runs into a single ts-sorted parquet file, one batch at a time.
+
+    Runs with the compact schema are decoded, the output file always uses the non compact schema.
+
+    About `batch_size` rows are held in memory in total: every run is read in batches of an equal
+    share of `batch_size` rows, so peak memory doesn't grow with the number of runs. Rows are
+    emitted up to the smallest "last ts" of all runs that still have data, so rows with the same ts
+    always end up in the same batch and duplicate plays across runs are dropped there by their
+    fingerprint.
+
+    Args:
+        run_files: Parquet files that are each sorted by ts
+        output_file: Path to save the output parquet file
+        batch_size: Number of rows read from all runs at once and written per row group
+    """
+    run_batch_size = max(1, batch_size // max(1, len(run_files)))
+    readers = [iter_history_batches(run_file, run_batch_size) for run_file in run_files]
+    pending = [pd.DataFrame(columns=HISTORY_COLUMNS) for _ in readers]
+    exhausted = [False for _ in readers]
+    last_ts = [None for _ in readers]
+
+    def refill(i):
+        # Read batches until there is pending data or the run is exhausted
+        while not exhausted[i]:
+            try:
+                batch = next(readers[i])
+            except StopIteration:
+                exhausted[i] = True
+                return
+            if len(batch) > 0:
+                pending[i] = pd.concat([pending[i], batch]) if len(pending[i]) > 0 else batch
+                last_ts[i] = batch["ts"].iloc[-1]
+                return
+
+    writer = None
+    out_parts, out_rows = [], 0
+
+    def write(parts):
+        nonlocal writer
+        table = pa.Table.from_pandas(pd.concat(parts), preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(output_file, table.schema)
+        writer.write_table(table.cast(writer.schema), row_group_size=batch_size)
+
+    for i in range(len(readers)):
+        refill(i)
+
+    while True:
+        open_runs = [i for i in range(len(readers)) if not exhausted[i]]
+        watermark = min(last_ts[i] for i in open_runs) if open_runs else None
+
+        # Rows are only emitted once the buffer is full, so the runs aren't sliced after every refill
+        parts = []
+        if watermark is None or sum(len(df) for df in pending) >= batch_size:
+            for i, df in enumerate(pending):
+                split = len(df) if watermark is None else df["ts"].searchsorted(watermark, side="left")
+                if split > 0:
+                    parts.append(df.iloc[:split])
+                    pending[i] = df.iloc[split:]
+        if parts:
+            batch = drop_duplicate_records(pd.concat(parts).sort_values(by="ts", kind="stable"))
+            out_parts.append(batch)
+            out_rows += len(batch)
+            if out_rows >= batch_size:
+                write(out_parts)
+                out_parts, out_rows = [], 0
+
+        if watermark is None:
+            break
+        for i in open_runs:
+            if len(pending[i]) == 0 or last_ts[i] == watermark:
+                refill(i)
+
+    if out_parts or writer is None:
+        write(out_parts or [pd.DataFrame(columns=HISTORY_COLUMNS)])
+    writer.close()
+
+
+def combine_and_save_streaming(input_path, output_file, backend="arrow", workers=1):
+    """
+    Combine multiple Spotify JSON files into a single preprocessed parquet file with bounded memory.
+
+    Every JSON file is parsed and preprocessed on its own and spilled to a ts-sorted parquet run next
+    to the output file. The runs are then merged into the output parquet file with a fixed buffer of
+    STREAM_BATCH_ROWS rows split across all runs, so peak memory depends on the size of a single
+    export file (per worker) and not on the number of files.
+
+    Args:
+        input_path: Spotify data zip file or directory containing the JSON files
+        output_file: Path to save the output parquet file
+        backend: JSON reader backend, see read_export_file
+        workers: Number of processes that parse export files in parallel
+    """
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_file.parent) as tmp_dir:
+        export_files = list_export_files(input_path)
+        run_files = [Path(tmp_dir) / f"{i}.parquet" for i in range(len(export_files))]
+        map_export_files(save_export_run, export_files, run_files, repeat(backend), workers=workers)
+
+        merge_sorted_runs(run_files, output_file)
+    print(f"Saved combined data to {output_file}")
+
+
+def combine_and_save(input_path, output_file, streaming=False, backend="arrow", workers=1, compact=False):
     """
     Combine multiple Spotify JSON files into a single preprocessed parquet file
 
     Args:
-        input_dir: Directory containing the JSON files
+        input_path: Spotify data zip file or directory containing the JSON files
         output_file: Path to save the output parquet file
+        streaming: Process the files one by one with bounded memory instead of all at once
+        backend: JSON reader backend, see read_export_file
+        workers: Number of processes that parse and preprocess the export files in parallel
+        compact: Save the output with the compact schema, see storage.compact_history_file
     """
-    # Read and combine all JSON files
-    df = pd.concat(
-        [
-            read_json(os.path.join(input_dir, fn))
-            for fn in sorted(os.listdir(input_dir))
-            if fn.endswith(".json")
-        ]
-    )
+    if streaming:
+        combine_and_save_streaming(input_path, output_file, backend, workers)
+        if compact:
+            compact_history_file(output_file)
+        return
+
+    if workers > 1:
+        # Every file is filtered and pruned in a worker, only the global sort and dedup is left here
+        export_files = list_export_files(input_path)
+        df = pd.concat(map_export_files(load_export_file, export_files, repeat(backend), workers=workers))
+        df = drop_duplicate_records(df.sort_values(by="ts", kind="stable"))
+    else:
+        # Read and combine all JSON files
+        df = pd.concat(
+            [read_export_file(export_file, backend) for export_file in list_export_files(input_path)]
+        )
 
-    # Preprocess the data
-    df = preprocess_df(df)
+        # Preprocess the data
+        df = preprocess_df(df)
 
     # Save to parquet
     df.to_parquet(output_file, index=False)
+    if compact:
+        compact_history_file(output_file)
     print(f"Saved combined data to {output_file}")
 
 
+def hash_export_file(export_file):
+    """Return the sha256 hex digest of the content of an export file."""
+    sha256 = hashlib.sha256()
+    with open_export_file(export_file) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_manifest(manifest_file):
+    """Load the manifest of already ingested export files, {} if there is none yet."""
+    if not Path(manifest_file).exists():
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_file, manifest):
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def combine_and_save_incremental(
+    input_path, output_file, manifest_file, delta_file, backend="arrow", workers=1, compact=False
+):
+    """
+    Add only new or changed export files to an existing preprocessed parquet file.
+
+    The manifest records the content hash, ts range and row count of every ingested file, so files
+    of an earlier export are skipped without parsing them. Rows of the new files that are already
+    stored (re-exports overlap with older ones) are dropped by comparing their fingerprints with the
+    ones of the stored rows in the same ts range. The remaining rows are saved to `delta_file` and
+    merged into the ts-sorted output file, which allows downstream steps to only look at the delta.
+
+    Args:
+        input_path: Spotify data zip file or directory containing the JSON files
+        output_file: Path of the preprocessed parquet file, created if it doesn't exist yet
+        manifest_file: Path of the JSON manifest of ingested files
+        delta_file: Path to save the rows that were added in this run
+        backend: JSON reader backend, see read_export_file
+        workers: Number of processes that parse the new export files in parallel
+        compact: Save the output with the compact schema, kept if the existing output already uses it
+    """
+    output_file = Path(output_file)
+    manifest = load_manifest(manifest_file)
+    compact = compact or (output_file.exists() and is_compact(output_file))
+
+    new_files = []
+    for export_file in list_export_files(input_path):
+        name = Path(export_file[1]).name
+        sha256 = hash_export_file(export_file)
+        if manifest.get(name, {}).get("sha256") != sha256:
+            new_files.append((name, sha256, export_file))
+    print(f"{len(new_files)} new or changed export files")
+
+    dfs = map_export_files(load_export_file, [f[2] for f in new_files], repeat(backend), workers=workers)
+    if dfs:
+        delta = drop_duplicate_records(pd.concat(dfs).sort_values(by="ts", kind="stable"))
+    elif output_file.exists():
+        delta = next(iter_history_batches(output_file, 1)).iloc[:0]
+    else:
+        delta = pd.DataFrame(columns=HISTORY_COLUMNS)
+
+    if len(delta) > 0 and output_file.exists():
+        # Drop the rows that are already stored
+        stored = read_history(
+            output_file,
+            columns=RECORD_KEY_COLUMNS,
+            filters=[("ts", ">=", delta["ts"].min()), ("ts", "<=", delta["ts"].max())],
+            plain=True,
+        )
+        delta = delta[~record_fingerprints(delta).isin(record_fingerprints(stored))]
+
+    delta.to_parquet(delta_file, index=False)
+    if not output_file.exists():
+        delta.to_parquet(output_file, index=False)
+    elif len(delta) > 0:
+        merged_file = output_file.with_suffix(".merging.parquet")
+        merge_sorted_runs([output_file, delta_file], merged_file)
+        os.replace(merged_file, output_file)
+    if compact and len(delta) > 0:
+        compact_history_file(output_file)
+
+    for (name, sha256, _), df in zip(new_files, dfs):
+        manifest[name] = {
+            "sha256": sha256,
+            "ts_min": df["ts"].min().isoformat() if len(df) > 0 else None,
+            "ts_max": df["ts"].max().isoformat() if len(df) > 0 else None,
+            "rows": len(df),
+        }
+    save_manifest(manifest_file, manifest)
+    print(f"Added {len(delta)} new rows to {output_file}, saved them to {delta_file}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Extract Spotify streaming history from data download zip file"
     )
-    parser.add_argument("zip_path", type=str, help="Path to the Spotify data zip file")
+    parser.add_argument(
+        "zip_path",
+        type=str,
+        help="Path to the Spotify data zip file or a folder with the extracted JSON files",
+    )
+    parser.add_argument(
+        "--extract",
+        action="store_true",
+        help="Extract the streaming history to data/raw before processing instead of reading the zip in place",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Process the export file by file with bounded memory (for very large histories)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["arrow", "pandas"],
+        default="arrow",
+        help="JSON reader, arrow is faster and falls back to pandas for files it can't parse",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes that parse the export files in parallel",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only add new or changed export files to an existing database (e.g. for a newer data download)",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Save the listening history with dictionary encoded columns and integer track keys",
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="Also save the listening history as a year partitioned dataset for fast time range queries",
+    )
     args = parser.parse_args()
 
     raw_data_dir = Path("data/raw")
     output_file = Path("data/listening_history_without_ids.parquet")
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+
+    input_path = Path(args.zip_path)
+    if args.extract:
+        extract_spotify_data(input_path, raw_data_dir)
+        input_path = raw_data_dir
+    if args.incremental:
+        combine_and_save_incremental(
+            input_path,
+            output_file,
+            Path("data/ingest_manifest.json"),
+            Path("data/listening_history_without_ids_delta.parquet"),
+            backend=args.backend,
+            workers=args.workers,
+            compact=args.compact,
+        )
+    else:
+        combine_and_save(
+            input_path,
+            output_file,
+            streaming=args.streaming,
+            backend=args.backend,
+            workers=args.workers,
+            compact=args.compact,
+        )
 
-    extract_spotify_data(args.zip_path, raw_data_dir)
-    combine_and_save(raw_data_dir, output_file)
+    if args.partitioned:
+        save_partitioned_history(output_file, output_file.with_suffix(""))
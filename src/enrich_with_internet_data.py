@@ -1,174 +1,591 @@
 import argparse
 import json
+import multiprocessing
+import os
+import random
+import threading
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import islice
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import requests
 from tqdm import tqdm
 
-from util import get_spotify_bearer
+from entity_cache import CHUNK_SIZE, NEGATIVE_TTL, EntityCache, decode, import_json_cache
+from images import MANIFEST_FILE, download_images
+from pipeline import Pipeline, Stage, stop_requested
+from star_schema import FACT_FILE, save_star_schema
+from storage import read_history, save_partitioned_history
+from util import configure_http, http_get, http_post, save_json, spotify_request
+from wikidata_dump import read_artist_wikidata
+
+# Number of artists looked up with one Wikidata SPARQL query
+WIKIDATA_BATCH_SIZE = 200
+
+# Wikidata properties used for the artists parquet file: instance of, sex or gender,
+# country of citizenship, country of origin, date of birth, official website and genre
+WIKIDATA_PROPERTIES = ["P31", "P21", "P27", "P495", "P569", "P856", "P136"]
+
+# Manifest of the parquet files built from the cache, to only update them with the new data
+BUILD_MANIFEST_FILE = "build_manifest.json"
+
+# The build manifest is updated by stages running at the same time, e.g. albums_parquet and artists_parquet
+build_manifest_lock = threading.Lock()
+
+# Ids of the album artists of all tracks, saved next to tracks.parquet
+ALBUM_ARTISTS_FILE = "album_artist_ids.parquet"
+
+# State of the stages of the enrichment pipeline, to skip the ones whose inputs didn't change
+PIPELINE_STATE_FILE = "pipeline_state.json"
+
+# Plays per batch when joining the listening history with the tracks, albums and artists
+JOIN_BATCH_ROWS = 64 * 1024
+
+# Data types of the tracks, artists and albums parquet files, the artist_id is only added to the listening history
+TRACK_DTYPES = {
+    "track_id": "string",
+    "track_name": "string",
+    "track_duration_ms": "Int64",
+    "track_explicit": "bool",
+    "track_popularity": "Int16",
+    "track_number": "Int16",
+    "disc_number": "Int16",
+    "album_id": "string",
+    "artist_id": "string",
+    "artist_ids": "string",
+}
+ARTIST_DTYPES = {
+    "artist_id": "string",
+    "artist_name": "string",
+    "artist_followers": "Int32",
+    "artist_genres": "string",
+    "artist_popularity": "Int64",
+    "wikidata_entity_id": "string",
+    "is_band": "boolean",
+    "gender": "string",
+    "country": "string",
+    "birth_date": "datetime64[ns, UTC]",
+    "website": "string",
+}
+ALBUM_DTYPES = {
+    "album_id": "string",
+    "album_name": "string",
+    "album_type": "string",
+    "album_total_tracks": "Int16",
+    "album_label": "string",
+    "album_popularity": "Int16",
+    "album_artist_ids": "string",
+    "album_track_ids": "string",
+    "album_release_year": "Int16",
+}
+POPULARITY_HISTORY_DTYPES = {
+    "kind": "category",
+    "id": "string",
+    "fetched_at": "datetime64[ns, UTC]",
+    "popularity": "Int16",
+    "followers": "Int32",
+}
+
+
+class RateLimiter:
+    """
+    Token bucket that limits the request rate of all threads sharing it.
+
+    Up to `burst` requests can be made at once, after that `rate` requests per second. A 429 response
+    pauses every thread for its Retry-After and halves the rate, which then slowly recovers with
+    every successful request up to the initial rate.
+    """
+
+    def __init__(self, rate=10.0, burst=10, min_rate=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request can be made."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+                self.updated = max(self.updated, now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate + max(0.0, self.updated - now)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop all requests for `seconds` and slow down, called on a 429 response."""
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + seconds)
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.05 * self.max_rate)
+
+
+# Shared by all requests to the Spotify API
+spotify_rate_limiter = RateLimiter()
+
+
+class Budget:
+    """
+    Limits the number of requests or the time spent on requests, shared by all threads.
+
+    Every batch request takes one request from the budget. Once it is used up, or `seconds` after the
+    budget was created, no more requests are made.
+    """
+
+    def __init__(self, requests=None, seconds=None):
+        self.requests = requests
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.used = 0
+        self.lock = threading.Lock()
 
+    def take(self):
+        """Take one request from the budget, returns False if it is used up."""
+        with self.lock:
+            if self.requests is not None and self.used >= self.requests:
+                return False
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                return False
+            self.used += 1
+            return True
 
-def fetch_data(url, headers, params=None):
-    """Fetch data from Spotify API"""
-    response = requests.get(url, headers=headers, params=params)
-    time.sleep(0.1)
 
-    if response.status_code == 429:  # Rate limit exceeded
-        retry_after = int(response.headers.get("Retry-After", 1))
-        time.sleep(retry_after)
-        return fetch_data(url, headers, params)
+DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
 
-    if response.status_code == 401:  # Invalid token
-        raise ValueError("Invalid or expired Spotify token. Please refresh your token.")
 
-    response.raise_for_status()
-    return response.json()
+def parse_duration(value):
+    """Parse a duration like "30s", "10m", "2h" or "7d" to seconds."""
+    try:
+        if value[-1:] not in DURATION_UNITS:
+            raise ValueError
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration {value!r}, use e.g. 30s, 10m, 2h or 7d") from None
 
 
-def download_image(url, output_path):
+def parse_budget(value):
+    """Parse a budget like "500" (requests) or "30s", "10m" or "2h" (wall-clock time)."""
+    if value[-1:] in DURATION_UNITS:
+        return Budget(seconds=parse_duration(value))
     try:
-        image_response = requests.get(url)
-        image_response.raise_for_status()
-        with open(output_path, "wb") as img_file:
-            img_file.write(image_response.content)
-        return True
-    except requests.exceptions.RequestException as e:
-        print(f"Error downloading image: {e}")
-        return False
+        return Budget(requests=int(value))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid budget {value!r}, use e.g. 500, 30s, 10m or 2h") from None
+
+
+def fetch_data(url, params=None, max_retries=5, rate_limiter=spotify_rate_limiter):
+    """Fetch data from Spotify API, the access token is refreshed when it expires during a run"""
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        try:
+            response = spotify_request("GET", url, params=params)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff(attempt))
+            continue
+
+        if response.status_code == 429 and attempt < max_retries:  # Rate limit exceeded
+            rate_limiter.pause(int(response.headers.get("Retry-After", 1)))
+            continue
+
+        if response.status_code >= 500 and attempt < max_retries:
+            time.sleep(backoff(attempt))
+            continue
+
+        if response.status_code == 401:  # Still invalid after requesting a new token
+            raise ValueError("Spotify rejected a new access token. Please check your Spotify credentials.")
+
+        response.raise_for_status()
+        rate_limiter.success()
+        return response.json()
+
+
+def backoff(attempt):
+    """Exponential backoff with jitter in seconds for the given retry attempt."""
+    return min(60, 2**attempt) * random.uniform(0.5, 1.5)
+
+
+def fetch_batches(url, id_batches, desc, workers=8, budget=None):
+    """
+    Fetch batches of ids from a Spotify API endpoint with a thread pool.
+
+    All threads share the rate limiter of fetch_data, so at most `workers` requests are in flight
+    while the request rate stays within the limit. The batches are started in the given order and
+    only `workers` of them are submitted at once, so with a budget the first batches are fetched and
+    the rest is left for the next run, and no more batches are requested once the generator stops
+    (e.g. on an error) or the pipeline is interrupted.
+
+    Yields:
+        tuple: (batch_ids, response) for every successful batch in the order they finish
+    """
 
+    def fetch_batch(batch_ids):
+        if budget is not None and not budget.take():
+            return None
+        return fetch_data(url, {"ids": ",".join(batch_ids)})
 
-def save_raw_tracks_data(input_parquet, tracks_path, headers):
-    tracks_path.mkdir(parents=True, exist_ok=True)
-    df = pd.read_parquet(input_parquet)
-    track_ids = df["track_id"].unique().tolist()
-    uncached_track_ids = [i for i in track_ids if not (tracks_path / f"{i}.json").exists()]
+    skipped = 0
+    remaining = iter(id_batches)
+    futures = {}
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        with tqdm(total=len(id_batches), desc=desc) as progress:
+            while True:
+                if not stop_requested.is_set():
+                    for batch_ids in islice(remaining, workers - len(futures)):
+                        futures[pool.submit(fetch_batch, batch_ids)] = batch_ids
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_ids = futures.pop(future)
+                    progress.update()
+                    try:
+                        response = future.result()
+                    except requests.exceptions.RequestException as e:
+                        print(f"Error fetching {url}: {e}")
+                        continue
+                    if response is None:
+                        skipped += 1
+                    else:
+                        yield batch_ids, response
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    if skipped:
+        print(f"The budget is used up, {skipped} batches are left for the next run")
+
+
+def save_fetched(kind, cache, batch_ids, entities):
+    """
+    Save the entities of a batch response to the cache.
+
+    Spotify returns null for ids it doesn't know (anymore), they are saved as unresolved so they are
+    not requested again in every run.
+    """
+    cache.put_many(kind, [(i, data) for i, data in zip(batch_ids, entities) if data])
+    cache.put_unresolved(kind, [i for i, data in zip(batch_ids, entities) if not data], "spotify_null")
+
+
+def print_unresolved(cache, kind):
+    for reason, count in cache.unresolved_counts(kind).items():
+        print(f"{count} {kind} are skipped, they couldn't be resolved recently ({reason})")
+
+
+def track_play_time(history_parquet):
+    """Return the total ms_played of every track_id in a listening history, sorted descending."""
+    df = read_history(history_parquet, columns=["track_id", "ms_played"])
+    ms_played = df.groupby("track_id", observed=True)["ms_played"].sum()
+    ms_played.index = ms_played.index.astype("string")
+    return ms_played.sort_values(ascending=False, kind="stable")
+
+
+def save_raw_tracks_data(input_parquet, cache, workers=8, budget=None, refresh_before=None):
+    """
+    Fetch the tracks of a listening history that are not cached yet, returns False if some are still missing.
+
+    The most listened tracks are fetched first. With refresh_before, tracks fetched before that
+    time are fetched again to update their popularity.
+    """
+    track_ids = track_play_time(input_parquet).index.tolist()
+    uncached_track_ids = cache.missing_ids("tracks", track_ids, refresh_before)
 
     # Process tracks
     if uncached_track_ids:
         url = "https://api.spotify.com/v1/tracks"
-        for i in tqdm(range(0, len(uncached_track_ids), 50), desc="Fetching track data"):
-            batch_ids = uncached_track_ids[i : i + 50]
-            try:
-                params = {"ids": ",".join(batch_ids)}
-                response = fetch_data(url, headers, params)
-                for j, track_data in enumerate(response["tracks"]):
-                    with open(tracks_path / f"{batch_ids[j]}.json", "w") as f:
-                        json.dump(track_data, f, indent=2)
-            except requests.exceptions.RequestException as e:
-                print(f"Error fetching track data: {e}")
-
+        batches = [uncached_track_ids[i : i + 50] for i in range(0, len(uncached_track_ids), 50)]
+        for batch_ids, response in fetch_batches(url, batches, "Fetching track data", workers, budget):
+            save_fetched("tracks", cache, batch_ids, response["tracks"])
+
+    still_missing = cache.missing_ids("tracks", uncached_track_ids, refresh_before)
+    print_unresolved(cache, "tracks")
+    if still_missing:
+        print(f"{len(still_missing)} tracks are not fetched yet")
+        return False
     print("all track data fetched")
+    return True
 
 
-def save_tracks_parquet(input_parquet, tracks_path, output_parquet):
-    tracks_data = []
-    album_ids = set()
-    artist_ids = set()
-
-    # Read all track JSON files
-    for track_file in tqdm(list(tracks_path.glob("*.json")), desc="Processing tracks"):
-        with open(track_file) as f:
-            track = json.load(f)
-
-            # Collect IDs
-            album_ids.add(track["album"]["id"])
-            for artist in track["artists"]:
-                artist_ids.add(artist["id"])
-            for artist in track["album"]["artists"]:
-                artist_ids.add(artist["id"])
-
-            track_data = {
-                "track_id": track["id"],
-                "track_name": track["name"],
-                "track_duration_ms": track["duration_ms"],
-                "track_explicit": track["explicit"],
-                "track_popularity": track["popularity"],
-                "track_number": track["track_number"],
-                "disc_number": track["disc_number"],
-                "album_id": track["album"]["id"],
-                "artist_id": track["artists"][0]["id"],
-                "artist_ids": ";".join([artist["id"] for artist in track["artists"]]),
-            }
-            tracks_data.append(track_data)
-
-    # Create DataFrame, drop duplicates, and set data types
-    df = pd.DataFrame(tracks_data)
-    df = df.drop_duplicates()
-
-    # Set data types
-    df = df.astype(
-        {
-            "track_id": "string",
-            "track_name": "string",
-            "track_duration_ms": "Int64",
-            "track_explicit": "bool",
-            "track_popularity": "Int16",
-            "track_number": "Int16",
-            "disc_number": "Int16",
-            "album_id": "string",
-            "artist_id": "string",
-            "artist_ids": "string",
-        }
-    )
+def map_chunks(func, chunks, processes=1):
+    """
+    Apply func to chunks in a process pool if more than one process is used, yielding the results in order.
+
+    At most two chunks per process are submitted at once, so the chunks are read while the
+    processes are busy without reading all of them into memory. The processes are started with
+    "spawn", since stages run in threads and forking a process with threads is not safe.
+    """
+    if processes <= 1:
+        yield from map(func, chunks)
+        return
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(func, chunk))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def pandas_schema(dtypes):
+    """Return the Arrow schema of a DataFrame with the given {column: dtype}."""
+    df = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in dtypes.items()})
+    return pa.Schema.from_pandas(df, preserve_index=False)
+
+
+def write_parquet_batches(batches, output_parquet, schema, progress, key=None, replaced_ids=None):
+    """
+    Write record batches to a parquet file, updating the tqdm progress bar by the rows written.
+
+    With replaced_ids, the rows of the existing file are kept except the ones whose `key` is in
+    replaced_ids, and the batches are added to them (an upsert). The file is written to a temporary
+    file first and replaced when it is complete.
+    """
+    output_parquet = Path(output_parquet)
+    part_file = output_parquet.with_suffix(".updating.parquet")
+    with progress, pq.ParquetWriter(part_file, schema) as writer:
+        if replaced_ids is not None and output_parquet.exists():
+            replaced = pa.array(replaced_ids, pa.string())
+            existing = pq.ParquetFile(output_parquet)
+            # iter_batches fails on files without row groups, e.g. when nothing was cached at the last build
+            for batch in existing.iter_batches() if existing.num_row_groups else []:
+                writer.write_batch(batch.filter(pc.invert(pc.is_in(batch.column(key), value_set=replaced))))
+        for batch in batches:
+            writer.write_batch(batch)
+            progress.update(batch.num_rows)
+    part_file.replace(output_parquet)
+
+
+def load_build_manifest(data_dir):
+    """
+    Load the manifest of the parquet files built by this script.
 
-    # Add album and artist IDs to listening history
-    listening_history = pd.read_parquet(input_parquet)
-    listening_history.merge(df[["track_id", "artist_id"]], on="track_id", how="left")[
+    Returns:
+        dict: {file name: {"fetched_at": {kind: time of the last cached entity included}}}
+    """
+    manifest_file = Path(data_dir) / BUILD_MANIFEST_FILE
+    if not manifest_file.exists():
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def save_build_manifest(data_dir, manifest):
+    save_json(Path(data_dir) / BUILD_MANIFEST_FILE, manifest, indent=2)
+
+
+def mark_built(output_parquet, fetched_at):
+    """Record the time of the last cached entity of every kind included in a parquet file."""
+    with build_manifest_lock:
+        manifest = load_build_manifest(output_parquet.parent)
+        manifest[output_parquet.name] = {"fetched_at": fetched_at}
+        save_build_manifest(output_parquet.parent, manifest)
+
+
+def last_build(cache, output_parquet, kinds):
+    """
+    Return when a parquet file built from the cache was last built.
+
+    Returns:
+        tuple: ({kind: time of the last cached entity in the file} or None if the file has to be
+            built from scratch, {kind: time of the last cached entity now} to pass to mark_built)
+    """
+    fetched_at = {kind: cache.last_fetched_at(kind) for kind in kinds}
+    with build_manifest_lock:
+        entry = load_build_manifest(output_parquet.parent).get(output_parquet.name)
+    if not output_parquet.exists() or entry is None:
+        return None, fetched_at
+    return entry["fetched_at"], fetched_at
+
+
+def parse_tracks_chunk(rows):
+    """
+    Convert a chunk of cached tracks to a record batch of the tracks parquet file.
+
+    The batch has the additional artist_id column, which is only added to the listening history.
+
+    Returns:
+        tuple: (record batch, ids of the album artists of the tracks)
+    """
+    columns = {col: [] for col in TRACK_DTYPES}
+    album_artist_ids = set()
+    for _, data in rows:
+        track = decode(data)
+        album_artist_ids.update(artist["id"] for artist in track["album"]["artists"])
+        columns["track_id"].append(track["id"])
+        columns["track_name"].append(track["name"])
+        columns["track_duration_ms"].append(track["duration_ms"])
+        columns["track_explicit"].append(track["explicit"])
+        columns["track_popularity"].append(track["popularity"])
+        columns["track_number"].append(track["track_number"])
+        columns["disc_number"].append(track["disc_number"])
+        columns["album_id"].append(track["album"]["id"])
+        columns["artist_id"].append(track["artists"][0]["id"])
+        columns["artist_ids"].append(";".join([artist["id"] for artist in track["artists"]]))
+
+    df = pd.DataFrame(columns).astype(TRACK_DTYPES)
+    return pa.RecordBatch.from_pandas(df, preserve_index=False).drop_columns(["artist_id"]), album_artist_ids
+
+
+def save_tracks_parquet(input_parquet, cache, output_parquet, processes=1):
+    """
+    Save the cached tracks as parquet file and add the artist_id to the listening history.
+
+    The cached tracks are converted chunk by chunk in `processes` processes and written to the
+    parquet file as record batches. Every track is cached once, so there are no duplicates to drop.
+    If the file exists, only the tracks fetched since it was built are converted and upserted.
+
+    The ids of the album artists of the tracks are saved to ALBUM_ARTISTS_FILE, so the artists can
+    be fetched without waiting for the albums.
+    """
+    output_parquet = Path(output_parquet)
+    album_artists_parquet = output_parquet.parent / ALBUM_ARTISTS_FILE
+    album_artist_ids = set()
+
+    def track_batches(chunks):
+        for batch, chunk_album_artist_ids in map_chunks(parse_tracks_chunk, chunks, processes):
+            album_artist_ids.update(chunk_album_artist_ids)
+            yield batch
+
+    since, fetched_at = last_build(cache, output_parquet, ["tracks"])
+    if not album_artists_parquet.exists():
+        since = None
+    since_tracks = since and since["tracks"]
+    changed_count = cache.count("tracks", since_tracks)
+    if since is None or changed_count:
+        write_parquet_batches(
+            track_batches(cache.iter_raw_chunks("tracks", since_tracks)),
+            output_parquet,
+            pandas_schema({col: dtype for col, dtype in TRACK_DTYPES.items() if col != "artist_id"}),
+            tqdm(total=changed_count, desc="Processing tracks"),
+            key="track_id",
+            replaced_ids=None if since is None else cache.ids("tracks", since_tracks),
+        )
+        if since is not None:
+            album_artist_ids.update(pd.read_parquet(album_artists_parquet)["artist_id"])
+        pd.DataFrame({"artist_id": pd.Series(sorted(album_artist_ids), dtype="string")}).to_parquet(
+            album_artists_parquet, index=False
+        )
+        mark_built(output_parquet, fetched_at)
+        print(f"Created tracks parquet file at {output_parquet}")
+    else:
+        print(f"{output_parquet} is up to date")
+
+    # Add album and artist IDs to listening history, the artist_id is the first of the artist_ids
+    tracks = pd.read_parquet(output_parquet, columns=["track_id", "artist_ids"])
+    track_artists = pd.DataFrame(
+        {"track_id": tracks["track_id"], "artist_id": tracks["artist_ids"].str.split(";").str[0]}
+    ).astype("string")
+    listening_history = read_history(input_parquet)
+    listening_history.merge(track_artists, on="track_id", how="left")[
         ["track_id", "artist_id"] + [col for col in listening_history.columns if col != "track_id"]
-    ].to_parquet(data_dir / "listening_history.parquet", index=False)
+    ].to_parquet(output_parquet.parent / "listening_history.parquet", index=False)
+
 
-    df = df.drop(columns=["artist_id"])
-    df.to_parquet(output_parquet, index=False)
-    print(f"Created tracks parquet file at {output_parquet}")
+def referenced_album_ids(tracks_parquet, history_parquet):
+    """Return the ids of the albums of all tracks, the most listened albums first."""
+    tracks = pd.read_parquet(tracks_parquet, columns=["track_id", "album_id"])
+    tracks["ms_played"] = tracks["track_id"].map(track_play_time(history_parquet)).fillna(0)
+    ms_played = tracks.dropna(subset=["album_id"]).groupby("album_id")["ms_played"].sum()
+    return ms_played.sort_values(ascending=False, kind="stable").index.tolist()
 
-    return list(album_ids), list(artist_ids)
 
+def referenced_artist_ids(tracks_parquet, album_artists_parquet, history_parquet):
+    """Return the ids of the artists of all tracks and of their albums, the most listened artists first."""
+    tracks = pd.read_parquet(tracks_parquet, columns=["track_id", "artist_ids"])
+    tracks["ms_played"] = tracks["track_id"].map(track_play_time(history_parquet)).fillna(0)
+    album_artists = pd.read_parquet(album_artists_parquet).rename(columns={"artist_id": "artist_ids"})
+    album_artists["ms_played"] = 0.0
+    artists = pd.concat([tracks, album_artists]).assign(artist_id=lambda df: df["artist_ids"].str.split(";"))
+    artists = artists.explode("artist_id")
+    artists = artists[artists["artist_id"].notna() & (artists["artist_id"] != "")]
+    ms_played = artists.groupby("artist_id")["ms_played"].sum()
+    return ms_played.sort_values(ascending=False, kind="stable").index.tolist()
 
-def save_raw_artists_data(artists_path, artist_ids, headers):
-    artists_path.mkdir(parents=True, exist_ok=True)
-    # Create images directory
-    images_path = artists_path.parent / "artist_images"
-    images_path.mkdir(parents=True, exist_ok=True)
 
-    uncached_artist_ids = [i for i in artist_ids if not (artists_path / f"{i}.json").exists()]
+def save_raw_artists_data(cache, artist_ids, workers=8, budget=None, refresh_before=None):
+    """
+    Fetch the artists that are not cached yet, returns False if some are still missing.
+
+    With refresh_before, artists fetched before that time are fetched again to update their popularity.
+    """
+    uncached_artist_ids = cache.missing_ids("artists", artist_ids, refresh_before)
 
     # Process artists
     if uncached_artist_ids:
         url = "https://api.spotify.com/v1/artists"
-        for i in tqdm(range(0, len(uncached_artist_ids), 50), desc="Fetching artist data"):
-            batch_ids = uncached_artist_ids[i : i + 50]
-            try:
-                response = fetch_data(url, headers, {"ids": ",".join(batch_ids)})
-                for j, artist_data in enumerate(response["artists"]):
-                    with open(artists_path / f"{batch_ids[j]}.json", "w") as f:
-                        json.dump(artist_data, f, indent=2)
-
-            except requests.exceptions.RequestException as e:
-                print(f"Error fetching artist data: {e}")
+        batches = [uncached_artist_ids[i : i + 50] for i in range(0, len(uncached_artist_ids), 50)]
+        for batch_ids, response in fetch_batches(url, batches, "Fetching artist data", workers, budget):
+            save_fetched("artists", cache, batch_ids, response["artists"])
+
+    still_missing = cache.missing_ids("artists", uncached_artist_ids, refresh_before)
+    print_unresolved(cache, "artists")
+    if still_missing:
+        print(f"{len(still_missing)} artists are not fetched yet")
+        return False
+    print("all artist data fetched")
+    return True
 
-    print("all artist data and images fetched")
 
+def save_genre_tables(artists_parquet, genres_parquet, artist_genres_parquet):
+    """
+    Save the genres of artists.parquet as a genre table and an artist to genre bridge table.
 
-def download_artist_images(artists_path, images_path):
-    """Download images for all artists in the artists directory."""
-    images_path.mkdir(parents=True, exist_ok=True)
+    genres_parquet has a genre_id (int32, the genres sorted by name) and the genre of every genre,
+    together with the artist_ids of the genre as an inverted index. artist_genres_parquet has one
+    (artist_id, genre_id) row per genre of an artist, sorted by artist_id.
+    """
+    artists = pd.read_parquet(artists_parquet, columns=["artist_id", "artist_genres"])
+    bridge = (
+        artists.assign(genre=artists["artist_genres"].str.split(";"))
+        .explode("genre")
+        .dropna(subset=["genre"])
+        .query("genre != ''")
+        .drop_duplicates(["artist_id", "genre"])
+    )
+    genre_names = pd.Series(sorted(bridge["genre"].unique()), dtype="string")
+    genre_ids = pd.Series(np.arange(len(genre_names), dtype=np.int32), index=genre_names)
+    bridge = pd.DataFrame(
+        {"artist_id": bridge["artist_id"].astype("string"), "genre_id": bridge["genre"].map(genre_ids)}
+    ).sort_values(["artist_id", "genre_id"], ignore_index=True)
+
+    artist_ids = bridge.groupby("genre_id")["artist_id"].agg(list)
+    pd.DataFrame(
+        {
+            "genre_id": genre_ids.to_numpy(),
+            "genre": genre_names,
+            "artist_ids": genre_ids.map(artist_ids).to_numpy(),
+        }
+    ).to_parquet(genres_parquet, index=False)
+    bridge.to_parquet(artist_genres_parquet, index=False)
+    print(f"Created genre tables at {genres_parquet} and {artist_genres_parquet}")
 
-    ids_to_process = [
-        f.stem for f in artists_path.glob("*.json") if not (images_path / f"{f.stem}.jpg").exists()
-    ]
-    for artist_id in tqdm(ids_to_process, desc="Downloading artist images"):
-        image_path = images_path / f"{artist_id}.jpg"
 
-        with open(artists_path / f"{artist_id}.json") as f:
-            artist_data = json.load(f)
-            if artist_data["images"] and artist_data["images"][0]["url"]:
-                image_url = artist_data["images"][0]["url"]
-                if not download_image(image_url, image_path):
-                    print(f"Failed to download image for artist {artist_id}")
+def download_artist_images(cache, images_path, workers=16, thumbnail_size=None):
+    """Download images for all cached artists, returns False if some downloads failed."""
+    artist_images = ((artist_id, artist["images"]) for artist_id, artist in cache.get_many("artists"))
+    complete = download_images(
+        artist_images, images_path, "Downloading artist images", workers, thumbnail_size
+    )
 
     print("All artist images downloaded")
+    return complete
 
 
 def fetch_artist_wikidata(spotify_id):
@@ -189,7 +606,7 @@ def fetch_artist_wikidata(spotify_id):
     """
 
     try:
-        response = requests.get(
+        response = http_get(
             endpoint_url,
             params={"query": query, "format": "json"},
             headers={"User-Agent": "MusicDataAnalysis/1.0"},
@@ -202,227 +619,409 @@ def fetch_artist_wikidata(spotify_id):
         return None
 
 
-def save_artist_wikidata(artists_path, wikidata_path):
-    """Download Wikidata for all artists and save as JSON files."""
-    wikidata_path.mkdir(parents=True, exist_ok=True)
+def fetch_artists_wikidata(spotify_ids):
+    """
+    Fetch Wikidata information for many artists with one SPARQL query.
 
-    # Process only artists that don't have wikidata yet
-    for artist_file in tqdm(list(artists_path.glob("*.json")), desc="Fetching Wikidata"):
-        wikidata_file = wikidata_path / f"{artist_file.stem}.json"
+    Only the properties used by save_artists_parquet are selected. The query is sent as a POST
+    request, since hundreds of ids don't fit into a URL.
+
+    Returns:
+        dict: {spotify_id: SPARQL JSON result of that artist} with the same format as
+            fetch_artist_wikidata, or None if the request failed
+    """
+    endpoint_url = "https://query.wikidata.org/sparql"
+    values = " ".join(f'"{spotify_id}"' for spotify_id in spotify_ids)
+    props = " ".join(f"wdt:{prop}" for prop in WIKIDATA_PROPERTIES)
 
-        if not wikidata_file.exists():
-            artist_id = artist_file.stem  # This is the Spotify ID
+    query = f"""
+    SELECT ?sid ?item ?propLabel ?valueLabel WHERE {{
+      VALUES ?sid {{ {values} }}
+      VALUES ?prop {{ {props} }}
+      ?item wdt:P1902 ?sid .
+      ?item ?prop ?value .
+      ?property wikibase:directClaim ?prop .
+      SERVICE wikibase:label {{
+        bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en".
+        ?property rdfs:label ?propLabel .
+        ?value rdfs:label ?valueLabel .
+      }}
+    }}
+    """
+
+    try:
+        response = http_post(
+            endpoint_url,
+            data={"query": query, "format": "json"},
+            headers={"User-Agent": "MusicDataAnalysis/1.0"},
+        )
+        response.raise_for_status()
+        bindings = response.json()["results"]["bindings"]
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print(f"Error fetching Wikidata for {len(spotify_ids)} Spotify IDs: {e}")
+        return None
+
+    # Split the results back into one result per artist
+    results = {spotify_id: {"results": {"bindings": []}} for spotify_id in spotify_ids}
+    for binding in bindings:
+        spotify_id = binding.pop("sid")["value"]
+        if spotify_id in results:
+            results[spotify_id]["results"]["bindings"].append(binding)
+    return results
+
+
+def save_artist_wikidata(cache, batch_size=WIKIDATA_BATCH_SIZE, dump_file=None):
+    """
+    Download Wikidata for all cached artists and save it in the cache.
+
+    With a batch_size above 1, the artists are looked up with one query per batch_size artists
+    instead of one query per artist. With a dump_file, the artists are read from a local Wikidata
+    JSON dump instead of querying the Wikidata SPARQL endpoint. Artists without a Wikidata item are
+    saved as unresolved and looked up again after the negative TTL of the cache. Returns False if
+    some requests failed.
+    """
+    # Process only artists that don't have wikidata yet
+    artist_ids = cache.missing_ids("artist_wikidata", cache.ids("artists"))
+    complete = True
+
+    if dump_file is not None:
+        if artist_ids:
+            save_wikidata_results(cache, read_artist_wikidata(dump_file, artist_ids))
+    elif batch_size > 1:
+        batches = [artist_ids[i : i + batch_size] for i in range(0, len(artist_ids), batch_size)]
+        for batch_ids in tqdm(batches, desc="Fetching Wikidata"):
+            if stop_requested.is_set():
+                complete = False
+                break
+            results = fetch_artists_wikidata(batch_ids)
+            # Failed batches are not cached and retried in the next run
+            if results is not None:
+                save_wikidata_results(cache, results)
+            else:
+                complete = False
+    else:
+        for artist_id in tqdm(artist_ids, desc="Fetching Wikidata"):
+            if stop_requested.is_set():
+                complete = False
+                break
             time.sleep(0.01)  # Rate limiting
             wikidata = fetch_artist_wikidata(artist_id)
+            if wikidata is not None:
+                save_wikidata_results(cache, {artist_id: wikidata})
+            else:
+                complete = False
 
-            # Save either the wikidata or an empty dict if no data was found
-            with open(wikidata_file, "w") as f:
-                json.dump(wikidata if wikidata else {}, f, indent=2)
-
+    print_unresolved(cache, "artist_wikidata")
     print("All artist Wikidata fetched")
+    return complete
+
+
+def save_wikidata_results(cache, results):
+    """Save {spotify_id: SPARQL JSON result} to the cache, artists without results as unresolved."""
+    found = {spotify_id: result for spotify_id, result in results.items() if result["results"]["bindings"]}
+    cache.put_many("artist_wikidata", found.items())
+    cache.put_unresolved("artist_wikidata", results.keys() - found.keys(), "not_in_wikidata")
+
+
+def parse_artists_chunk(rows):
+    """Convert a chunk of cached (id, artist, wikidata or None) rows to a record batch of the artists parquet file."""
+    columns = {col: [] for col in ARTIST_DTYPES}
+    for _, data, wikidata_data in rows:
+        artist = decode(data)
+
+        # Load Wikidata
+        wikidata_entity_id = None
+        gender = None
+        citizenship_or_country_of_origin = None
+        birth_date = None
+        website = None
+        is_band = None
+        all_genres = set(artist["genres"] if artist["genres"] else [])  # Start with Spotify genres
+
+        if wikidata_data is not None:
+            wikidata = decode(wikidata_data)
+
+            if wikidata != {} and len(wikidata["results"]["bindings"]) > 0:
+                wikidata_entity_id = wikidata["results"]["bindings"][0]["item"]["value"].split("/")[-1]
+                for binding in wikidata["results"]["bindings"]:
+                    prop_label = binding["propLabel"]["value"].lower()
+                    value_label = binding["valueLabel"]["value"]
+                    if prop_label == "instance of":
+                        if value_label in ["human", "solo musical project"]:
+                            is_band = False
+                        elif value_label in [
+                            "musical group",
+                            "musical duo",
+                            "rock band",
+                            "orchestra",
+                            "symphony orchestra",
+                            "sibling duo",
+                            "musical trio",
+                            "girl group",
+                            "musical ensemble",
+                            "rap group",
+                        ]:
+                            is_band = True
+                    elif prop_label == "sex or gender":
+                        gender = value_label
+                    elif prop_label in ["country of citizenship", "country of origin"]:
+                        citizenship_or_country_of_origin = value_label
+                    elif prop_label == "date of birth":
+                        birth_date = value_label
+                    elif prop_label == "official website":
+                        website = value_label
+                    elif prop_label == "genre":
+                        all_genres.add(value_label)
+
+        # Add flattened artist data
+        columns["artist_id"].append(artist["id"])
+        columns["artist_name"].append(artist["name"])
+        columns["artist_followers"].append(artist["followers"]["total"])
+        columns["artist_genres"].append(";".join(sorted(all_genres)) if all_genres else "")
+        columns["artist_popularity"].append(artist["popularity"])
+        columns["wikidata_entity_id"].append(wikidata_entity_id)
+        columns["is_band"].append(is_band)
+        columns["gender"].append(gender)
+        columns["country"].append(citizenship_or_country_of_origin)
+        columns["birth_date"].append(birth_date)
+        columns["website"].append(website)
+
+    df = pd.DataFrame(columns)
+    # Convert birth_date to datetime, Wikidata dates are in UTC
+    df["birth_date"] = pd.to_datetime(df["birth_date"], errors="coerce", utc=True)
+    df = df.astype(ARTIST_DTYPES)
+    return pa.RecordBatch.from_pandas(df, preserve_index=False)
+
+
+def iter_artist_chunks(cache, artist_ids=None):
+    """Yield chunks of cached (id, artist, wikidata or None) rows of all or the given artists, all still compressed."""
+    if artist_ids is None:
+        chunks = cache.iter_raw_chunks("artists")
+    else:
+        chunks = (
+            list(cache.get_raw("artists", artist_ids[i : i + CHUNK_SIZE]).items())
+            for i in range(0, len(artist_ids), CHUNK_SIZE)
+        )
+    for rows in chunks:
+        wikidata = cache.get_raw("artist_wikidata", [artist_id for artist_id, _ in rows])
+        yield [(artist_id, data, wikidata.get(artist_id)) for artist_id, data in rows]
 
 
-def save_artists_parquet(artists_path, wikidata_path, output_parquet):
-    artists_data = []
-    # Read all artist JSON files
-    for artist_file in tqdm(list(artists_path.glob("*.json")), desc="Processing artists"):
-        with open(artist_file) as f:
-            artist = json.load(f)
-
-            # Load Wikidata
-            wikidata_file = wikidata_path / f"{artist['id']}.json"
-            wikidata_entity_id = None
-            gender = None
-            citizenship_or_country_of_origin = None
-            birth_date = None
-            website = None
-            is_band = None
-            all_genres = set(artist["genres"] if artist["genres"] else [])  # Start with Spotify genres
-
-            if wikidata_file.exists():
-                with open(wikidata_file) as wf:
-                    wikidata = json.load(wf)
-
-                    if wikidata != {} and len(wikidata["results"]["bindings"]) > 0:
-                        wikidata_entity_id = wikidata["results"]["bindings"][0]["item"]["value"].split("/")[
-                            -1
-                        ]
-                        for binding in wikidata["results"]["bindings"]:
-                            prop_label = binding["propLabel"]["value"].lower()
-                            value_label = binding["valueLabel"]["value"]
-                            if prop_label == "instance of":
-                                if value_label in ["human", "solo musical project"]:
-                                    is_band = False
-                                elif value_label in [
-                                    "musical group",
-                                    "musical duo",
-                                    "rock band",
-                                    "orchestra",
-                                    "symphony orchestra",
-                                    "sibling duo",
-                                    "musical trio",
-                                    "girl group",
-                                    "musical ensemble",
-                                    "rap group",
-                                ]:
-                                    is_band = True
-                            elif prop_label == "sex or gender":
-                                gender = value_label
-                            elif prop_label in ["country of citizenship", "country of origin"]:
-                                citizenship_or_country_of_origin = value_label
-                            elif prop_label == "date of birth":
-                                birth_date = value_label
-                            elif prop_label == "official website":
-                                website = value_label
-                            elif prop_label == "genre":
-                                all_genres.add(value_label)
-
-            # Create flattened artist data
-            artist_data = {
-                "artist_id": artist["id"],
-                "artist_name": artist["name"],
-                "artist_followers": artist["followers"]["total"],
-                "artist_genres": ";".join(sorted(all_genres)) if all_genres else "",
-                "artist_popularity": artist["popularity"],
-                "wikidata_entity_id": wikidata_entity_id,
-                "is_band": is_band,
-                "gender": gender,
-                "country": citizenship_or_country_of_origin,
-                "birth_date": birth_date,
-                "website": website,
-            }
-            artists_data.append(artist_data)
-
-    # Create DataFrame, drop duplicates, and save to parquet with specified dtypes
-    df = pd.DataFrame(artists_data)
-    df = df.drop_duplicates()
-
-    # Convert birth_date to datetime
-    df["birth_date"] = pd.to_datetime(df["birth_date"], errors="coerce")
-
-    # Set data types
-    df = df.astype(
-        {
-            "artist_id": "string",
-            "artist_name": "string",
-            "artist_followers": "Int32",
-            "artist_genres": "string",
-            "artist_popularity": "Int64",
-            # "top_track_ids": "string",
-            "wikidata_entity_id": "string",
-            "is_band": "boolean",
-            "gender": "string",
-            "country": "string",
-            "website": "string",
-        }
-    )
+def save_artists_parquet(cache, output_parquet, processes=1):
+    """
+    Save the cached artists and their Wikidata as parquet file, converted in `processes` processes.
 
-    df.to_parquet(output_parquet, index=False)
+    If the file exists, only the artists whose Spotify data or Wikidata was fetched since it was
+    built are converted and upserted.
+    """
+    output_parquet = Path(output_parquet)
+    since, fetched_at = last_build(cache, output_parquet, ["artists", "artist_wikidata"])
+    changed_ids = None
+    if since is not None:
+        changed_ids = sorted(
+            set(cache.ids("artists", since["artists"]))
+            | set(cache.ids("artist_wikidata", since["artist_wikidata"]))
+        )
+        if not changed_ids:
+            print(f"{output_parquet} is up to date")
+            return
+
+    write_parquet_batches(
+        map_chunks(parse_artists_chunk, iter_artist_chunks(cache, changed_ids), processes),
+        output_parquet,
+        pandas_schema(ARTIST_DTYPES),
+        tqdm(
+            total=cache.count("artists") if changed_ids is None else len(changed_ids),
+            desc="Processing artists",
+        ),
+        key="artist_id",
+        replaced_ids=changed_ids,
+    )
+    mark_built(output_parquet, fetched_at)
     print(f"Created artists parquet file at {output_parquet}")
 
 
-def save_raw_albums_data(albums_path, album_ids, headers):
-    albums_path.mkdir(parents=True, exist_ok=True)
-    uncached_album_ids = [i for i in album_ids if not (albums_path / f"{i}.json").exists()]
+def save_raw_albums_data(cache, album_ids, workers=8, budget=None, refresh_before=None):
+    """
+    Fetch the albums that are not cached yet, returns False if some are still missing.
+
+    With refresh_before, albums fetched before that time are fetched again to update their popularity.
+    """
+    uncached_album_ids = cache.missing_ids("albums", album_ids, refresh_before)
 
     # Process albums
     if uncached_album_ids:
         url = "https://api.spotify.com/v1/albums"
-        for i in tqdm(range(0, len(uncached_album_ids), 20), desc="Fetching album data"):
-            batch_ids = uncached_album_ids[i : i + 20]
-            try:
-                response = fetch_data(url, headers, {"ids": ",".join(batch_ids)})
-                for j, album_data in enumerate(response["albums"]):
-                    with open(albums_path / f"{batch_ids[j]}.json", "w") as f:
-                        json.dump(album_data, f, indent=2)
-            except requests.exceptions.RequestException as e:
-                print(f"Error fetching album data: {e}")
-
+        batches = [uncached_album_ids[i : i + 20] for i in range(0, len(uncached_album_ids), 20)]
+        for batch_ids, response in fetch_batches(url, batches, "Fetching album data", workers, budget):
+            save_fetched("albums", cache, batch_ids, response["albums"])
+
+    still_missing = cache.missing_ids("albums", uncached_album_ids, refresh_before)
+    print_unresolved(cache, "albums")
+    if still_missing:
+        print(f"{len(still_missing)} albums are not fetched yet")
+        return False
     print("all album data fetched")
-
-
-def save_albums_parquet(albums_path, output_parquet):
-    albums_data = []
-
-    # Read all album JSON files
-    for album_file in tqdm(list(albums_path.glob("*.json")), desc="Processing albums"):
-        with open(album_file) as f:
-            album = json.load(f)
-            album_data = {
-                "album_id": album["id"],
-                "album_name": album["name"],
-                "album_type": album["album_type"],
-                "album_total_tracks": album["total_tracks"],
-                "album_release_date": album["release_date"],
-                "album_release_date_precision": album["release_date_precision"],
-                "album_label": album["label"],
-                "album_popularity": album["popularity"],
-                "album_artist_ids": ";".join([artist["id"] for artist in album["artists"]]),
-                "album_track_ids": ";".join([track["id"] for track in album["tracks"]["items"]]),
-            }
-            albums_data.append(album_data)
-
-    # Create DataFrame, drop duplicates, and set data types
-    df = pd.DataFrame(albums_data)
-    df = df.drop_duplicates()
-
+    return True
+
+
+def parse_albums_chunk(rows):
+    """Convert a chunk of cached albums to a record batch of the albums parquet file."""
+    columns = {
+        col: []
+        for col in [
+            "album_id",
+            "album_name",
+            "album_type",
+            "album_total_tracks",
+            "album_release_date",
+            "album_label",
+            "album_popularity",
+            "album_artist_ids",
+            "album_track_ids",
+        ]
+    }
+    for _, data in rows:
+        album = decode(data)
+        columns["album_id"].append(album["id"])
+        columns["album_name"].append(album["name"])
+        columns["album_type"].append(album["album_type"])
+        columns["album_total_tracks"].append(album["total_tracks"])
+        columns["album_release_date"].append(album["release_date"])
+        columns["album_label"].append(album["label"])
+        columns["album_popularity"].append(album["popularity"])
+        columns["album_artist_ids"].append(";".join([artist["id"] for artist in album["artists"]]))
+        columns["album_track_ids"].append(";".join([track["id"] for track in album["tracks"]["items"]]))
+
+    df = pd.DataFrame(columns)
     df["album_release_date"] = df["album_release_date"].replace({"1900-01-01": "0"})
     df["album_release_year"] = pd.to_numeric(df["album_release_date"].str[:4], errors="coerce")
-    df = df.drop(["album_release_date", "album_release_date_precision"], axis=1)
+    df = df.drop(["album_release_date"], axis=1)
+    df = df.astype(ALBUM_DTYPES)
+    return pa.RecordBatch.from_pandas(df, preserve_index=False)
 
-    # Set data types
-    df = df.astype(
-        {
-            "album_id": "string",
-            "album_name": "string",
-            "album_type": "string",
-            "album_total_tracks": "Int16",
-            "album_release_year": "Int16",
-            "album_label": "string",
-            "album_popularity": "Int16",
-            "album_artist_ids": "string",
-            "album_track_ids": "string",
-        }
-    )
 
-    df.to_parquet(output_parquet, index=False)
+def save_albums_parquet(cache, output_parquet, processes=1):
+    """
+    Save the cached albums as parquet file, converted in `processes` processes.
+
+    If the file exists, only the albums fetched since it was built are converted and upserted.
+    """
+    output_parquet = Path(output_parquet)
+    since, fetched_at = last_build(cache, output_parquet, ["albums"])
+    since_albums = since and since["albums"]
+    changed_count = cache.count("albums", since_albums)
+    if since is not None and not changed_count:
+        print(f"{output_parquet} is up to date")
+        return
+
+    write_parquet_batches(
+        map_chunks(parse_albums_chunk, cache.iter_raw_chunks("albums", since_albums), processes),
+        output_parquet,
+        pandas_schema(ALBUM_DTYPES),
+        tqdm(total=changed_count, desc="Processing albums"),
+        key="album_id",
+        replaced_ids=None if since is None else cache.ids("albums", since_albums),
+    )
+    mark_built(output_parquet, fetched_at)
     print(f"Created albums parquet file at {output_parquet}")
 
 
-def download_album_images(albums_path, images_path):
-    """Download images for all albums in the albums directory."""
-    images_path.mkdir(parents=True, exist_ok=True)
+def download_album_images(cache, images_path, workers=16, thumbnail_size=None):
+    """Download images for all cached albums, returns False if some downloads failed."""
+    album_images = ((album_id, album["images"]) for album_id, album in cache.get_many("albums"))
+    complete = download_images(album_images, images_path, "Downloading album images", workers, thumbnail_size)
 
-    ids_to_process = [
-        f.stem for f in albums_path.glob("*.json") if not (images_path / f"{f.stem}.jpg").exists()
-    ]
-    for album_id in tqdm(ids_to_process, desc="Downloading album images"):
-        image_path = images_path / f"{album_id}.jpg"
+    print("All album images downloaded")
+    return complete
 
-        with open(albums_path / f"{album_id}.json") as f:
-            album_data = json.load(f)
-            if album_data["images"] and album_data["images"][0]["url"]:
-                image_url = album_data["images"][0]["url"]
-                if not download_image(image_url, image_path):
-                    print(f"Failed to download image for album {album_id}")
 
-    print("All album images downloaded")
+def save_popularity_history_parquet(cache, output_parquet):
+    """Save every fetched popularity (and followers of artists) of tracks, artists and albums."""
+    df = pd.DataFrame(cache.popularity_history(), columns=list(POPULARITY_HISTORY_DTYPES))
+    df["fetched_at"] = pd.to_datetime(df["fetched_at"], unit="s", utc=True)
+    df.astype(POPULARITY_HISTORY_DTYPES).to_parquet(output_parquet, index=False)
+    print(f"Created popularity history parquet file at {output_parquet}")
+
+
+class Dimension:
+    """Table of tracks, albums or artists held in memory with a hash index of its id column."""
+
+    def __init__(self, parquet_file, key):
+        self.table = pq.read_table(parquet_file)
+        self.key = key
+        self.index = pd.Index(self.table.column(key).to_pandas())
+        self.columns = [name for name in self.table.column_names if name != key]
+
+    def lookup(self, ids):
+        """Return the rows of the ids without the id column, null rows for unknown ids."""
+        if pa.types.is_dictionary(ids.type):
+            ids = ids.dictionary_decode()
+        positions = self.index.get_indexer(ids.to_pandas())
+        rows = self.table.select(self.columns).take(pa.array(positions, mask=positions < 0))
+        return rows.columns
 
 
-def save_listening_history_with_internet_data(data_dir, output_parquet):
-    df_tracks = pd.read_parquet(data_dir / "tracks.parquet")
-    df_albums = pd.read_parquet(data_dir / "albums.parquet")
-    df_artists = pd.read_parquet(data_dir / "artists.parquet")
-    df_history = pd.read_parquet(data_dir / "listening_history.parquet")
-    df_all = (
-        df_history.merge(df_tracks, on="track_id", how="left")
-        .merge(df_albums, on="album_id", how="left")
-        .merge(df_artists, on="artist_id", how="left")
+def save_listening_history_with_internet_data(data_dir, output_parquet, partitioned=False):
+    """
+    Join the listening history with the tracks, albums and artists and add hours_played.
+
+    The listening history is joined in batches of JOIN_BATCH_ROWS plays and every joined batch is
+    written right away, while the tracks, albums and artists are held in memory with a hash index
+    of their ids. This gives the same result as merging the whole tables, but only needs the
+    memory of one batch besides the much smaller tracks, albums and artists tables.
+    """
+    history_parquet = data_dir / "listening_history.parquet"
+    dimensions = [
+        (Dimension(data_dir / "tracks.parquet", "track_id"), "track_id"),
+        (Dimension(data_dir / "albums.parquet", "album_id"), "album_id"),
+        (Dimension(data_dir / "artists.parquet", "artist_id"), "artist_id"),
+    ]
+
+    # Schema of the joined table from the fields of the input files, with their pandas metadata so
+    # it reads back with the same dtypes (e.g. dictionary encoded columns of a compact history)
+    history_schema = pq.read_schema(history_parquet)
+    fields = list(history_schema)
+    pandas_metadata = dict(history_schema.pandas_metadata or {}, index_columns=[], column_indexes=[])
+    pandas_columns = list(pandas_metadata.get("columns", []))
+    for dimension, _ in dimensions:
+        fields += [dimension.table.schema.field(name) for name in dimension.columns]
+        pandas_columns += [
+            col
+            for col in (dimension.table.schema.pandas_metadata or {}).get("columns", [])
+            if col["name"] in dimension.columns
+        ]
+    fields.append(pa.field("hours_played", pa.float64()))
+    pandas_columns.append(
+        {
+            "name": "hours_played",
+            "field_name": "hours_played",
+            "pandas_type": "float64",
+            "numpy_type": "float64",
+            "metadata": None,
+        }
     )
-    df_all["hours_played"] = df_all["ms_played"] / (1000 * 60 * 60)
-    df_all.to_parquet(output_parquet, index=False)
+    names = {field.name for field in fields}
+    pandas_metadata["columns"] = [col for col in pandas_columns if col["field_name"] in names]
+    schema = pa.schema(fields, metadata={b"pandas": json.dumps(pandas_metadata).encode()})
+
+    history = pq.ParquetFile(history_parquet)
+    with pq.ParquetWriter(output_parquet, schema) as writer:
+        for batch in tqdm(
+            history.iter_batches(batch_size=JOIN_BATCH_ROWS),
+            total=-(-history.metadata.num_rows // JOIN_BATCH_ROWS),
+            desc="Joining listening history",
+        ):
+            columns = dict(zip(batch.schema.names, batch.columns))
+            for dimension, foreign_key in dimensions:
+                columns.update(zip(dimension.columns, dimension.lookup(columns[foreign_key])))
+            columns["hours_played"] = pc.divide(pc.cast(columns["ms_played"], pa.float64()), 1000 * 60 * 60)
+            writer.write_table(pa.table(columns).select(schema.names).cast(schema))
     print(f"Created listening history with internet data parquet file at {output_parquet}")
 
+    if partitioned:
+        save_partitioned_history(output_parquet, output_parquet.with_suffix(""))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fetch Spotify data")
@@ -431,31 +1030,263 @@ if __name__ == "__main__":
         action="store_true",
         help="Fetch artist top tracks data (slower, but provides additional data)",
     )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="Also save the final listening history as a year partitioned dataset for time range queries",
+    )
+    parser.add_argument(
+        "--star-schema",
+        action="store_true",
+        help="Save the final listening history as a fact table with dimension tables in data/star "
+        "instead of one wide table, see star_schema.read_star_schema",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="Maximum number of concurrent requests to the Spotify API"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=10.0, help="Maximum number of requests per second to the Spotify API"
+    )
+    parser.add_argument(
+        "--wikidata-batch-size",
+        type=int,
+        default=WIKIDATA_BATCH_SIZE,
+        help="Number of artists per Wikidata query, 1 to query every artist on its own",
+    )
+    parser.add_argument(
+        "--wikidata-dump",
+        type=Path,
+        default=None,
+        help="Read the artists from a local Wikidata JSON dump (.json, .json.gz or .json.bz2) instead",
+    )
+    parser.add_argument(
+        "--image-workers", type=int, default=16, help="Maximum number of concurrent image downloads"
+    )
+    parser.add_argument(
+        "--thumbnail-size",
+        type=int,
+        default=None,
+        help="Download the images in the smallest size that is at least this many pixels wide and "
+        "downscale them to it if Pillow is installed",
+    )
+    parser.add_argument(
+        "--stages",
+        type=lambda value: value.split(","),
+        default=None,
+        help="Comma separated stages to run (e.g. 'join'), all by default. See --list-stages",
+    )
+    parser.add_argument(
+        "--stage-workers",
+        type=int,
+        default=4,
+        help="Maximum number of stages running at the same time, e.g. the album and artist branches",
+    )
+    parser.add_argument("--list-stages", action="store_true", help="List the stages of the pipeline and exit")
+    parser.add_argument(
+        "--force", action="store_true", help="Run the stages even if their inputs didn't change"
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Build the parquet files from scratch instead of only adding the new and updated data",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes to build the tracks, artists and albums parquet files with",
+    )
+    parser.add_argument(
+        "--budget",
+        type=parse_budget,
+        default=None,
+        help="Maximum number of Spotify API requests (e.g. 500) or time (e.g. 30s, 10m or 2h) of this run. "
+        "The most listened tracks, albums and artists are fetched first, the rest in the next runs",
+    )
+    parser.add_argument(
+        "--refresh-ttl",
+        type=parse_duration,
+        default=None,
+        help="Fetch the tracks, albums and artists again that were fetched longer ago than this "
+        "(e.g. 7d or 12h), to update their popularity and followers",
+    )
+    parser.add_argument(
+        "--negative-ttl",
+        type=parse_duration,
+        default=NEGATIVE_TTL,
+        help="Time after which ids Spotify or Wikidata couldn't resolve are looked up again (e.g. 30d)",
+    )
+    parser.add_argument("--pool-size", type=int, default=16, help="Number of keep-alive connections per host")
+    parser.add_argument("--timeout", type=float, default=30, help="Timeout of HTTP requests in seconds")
     args = parser.parse_args()
 
     root_dir = Path(__file__).parent.parent
     data_dir = root_dir / "data"
     input_parquet = data_dir / "listening_history_without_ids.parquet"
-    spotify_data_dir = data_dir / "spotify_data"
-    tracks_path = spotify_data_dir / "tracks"
-    albums_path = spotify_data_dir / "albums"
-    artists_path = spotify_data_dir / "artists"
-
-    token = get_spotify_bearer()
-    headers = {"Authorization": f"Bearer {token}"}
+    cache_file = data_dir / "entity_cache.sqlite"
 
-    save_raw_tracks_data(input_parquet, tracks_path, headers)
-    album_ids, artist_ids = save_tracks_parquet(input_parquet, tracks_path, data_dir / "tracks.parquet")
+    # Import the one JSON file per entity cache of older versions
+    migrate_json_cache = not cache_file.exists()
+    cache = EntityCache(cache_file, negative_ttl=args.negative_ttl)
+    if migrate_json_cache:
+        import_json_cache(cache, data_dir)
 
-    save_raw_artists_data(artists_path, artist_ids, headers)
-    save_artist_wikidata(artists_path, data_dir / "artist_wikidata")
-    save_artists_parquet(artists_path, data_dir / "artist_wikidata", data_dir / "artists.parquet")
-    download_artist_images(artists_path, data_dir / "artist_images")
+    if args.rebuild:
+        (data_dir / BUILD_MANIFEST_FILE).unlink(missing_ok=True)
 
-    save_raw_albums_data(albums_path, album_ids, headers)
-    save_albums_parquet(albums_path, data_dir / "albums.parquet")
-    download_album_images(albums_path, data_dir / "album_images")
+    spotify_rate_limiter.rate = spotify_rate_limiter.max_rate = args.rate
+    configure_http(
+        pool_size=max(args.pool_size, args.workers, args.image_workers), timeout=(10, args.timeout)
+    )
 
-    save_listening_history_with_internet_data(
-        data_dir, data_dir / "listening_history_with_internet_data.parquet"
+    def cached(kind):
+        """Fingerprint of the cached entities of a kind."""
+        return lambda: [kind, cache.count(kind), cache.last_fetched_at(kind)]
+
+    tracks_parquet = data_dir / "tracks.parquet"
+    albums_parquet = data_dir / "albums.parquet"
+    artists_parquet = data_dir / "artists.parquet"
+    history_parquet = data_dir / "listening_history.parquet"
+    album_artists_parquet = data_dir / ALBUM_ARTISTS_FILE
+    output_parquet = data_dir / "listening_history_with_internet_data.parquet"
+    popularity_history_parquet = data_dir / "popularity_history.parquet"
+    star_dir = data_dir / "star"
+    genres_parquet = data_dir / "genres.parquet"
+    artist_genres_parquet = data_dir / "artist_genres.parquet"
+    refresh_before = None if args.refresh_ttl is None else time.time() - args.refresh_ttl
+
+    def stale(kind):
+        """Fingerprint of the cached entities of a kind that are older than the refresh TTL."""
+        return lambda: None if refresh_before is None else cache.count(kind, fetched_before=refresh_before)
+
+    def expired(kind):
+        """Fingerprint of the unresolved ids of a kind that are older than the negative TTL."""
+        return lambda: cache.expired_unresolved_count(kind)
+
+    pipeline = Pipeline(
+        data_dir / PIPELINE_STATE_FILE,
+        [
+            Stage(
+                "fetch_tracks",
+                lambda: save_raw_tracks_data(input_parquet, cache, args.workers, args.budget, refresh_before),
+                inputs=[input_parquet, stale("tracks"), expired("tracks")],
+            ),
+            Stage(
+                "tracks_parquet",
+                lambda: save_tracks_parquet(input_parquet, cache, tracks_parquet, args.processes),
+                inputs=[input_parquet, cached("tracks")],
+                outputs=[tracks_parquet, history_parquet, album_artists_parquet],
+                after=["fetch_tracks"],
+            ),
+            Stage(
+                "fetch_albums",
+                lambda: save_raw_albums_data(
+                    cache,
+                    referenced_album_ids(tracks_parquet, input_parquet),
+                    args.workers,
+                    args.budget,
+                    refresh_before,
+                ),
+                inputs=[tracks_parquet, stale("albums"), expired("albums")],
+                after=["tracks_parquet"],
+            ),
+            Stage(
+                "albums_parquet",
+                lambda: save_albums_parquet(cache, albums_parquet, args.processes),
+                inputs=[cached("albums")],
+                outputs=[albums_parquet],
+                after=["fetch_albums"],
+            ),
+            Stage(
+                "album_images",
+                lambda: download_album_images(
+                    cache, data_dir / "album_images", args.image_workers, args.thumbnail_size
+                ),
+                inputs=[cached("albums"), lambda: args.thumbnail_size],
+                outputs=[data_dir / "album_images" / MANIFEST_FILE],
+                after=["fetch_albums"],
+            ),
+            Stage(
+                "fetch_artists",
+                lambda: save_raw_artists_data(
+                    cache,
+                    referenced_artist_ids(tracks_parquet, album_artists_parquet, input_parquet),
+                    args.workers,
+                    args.budget,
+                    refresh_before,
+                ),
+                inputs=[tracks_parquet, album_artists_parquet, stale("artists"), expired("artists")],
+                after=["tracks_parquet"],
+            ),
+            Stage(
+                "artist_wikidata",
+                lambda: save_artist_wikidata(cache, args.wikidata_batch_size, args.wikidata_dump),
+                inputs=[cached("artists"), expired("artist_wikidata")],
+                after=["fetch_artists"],
+            ),
+            Stage(
+                "artists_parquet",
+                lambda: save_artists_parquet(cache, artists_parquet, args.processes),
+                inputs=[cached("artists"), cached("artist_wikidata")],
+                outputs=[artists_parquet],
+                after=["fetch_artists", "artist_wikidata"],
+            ),
+            Stage(
+                "genres",
+                lambda: save_genre_tables(artists_parquet, genres_parquet, artist_genres_parquet),
+                inputs=[artists_parquet],
+                outputs=[genres_parquet, artist_genres_parquet],
+                after=["artists_parquet"],
+            ),
+            Stage(
+                "artist_images",
+                lambda: download_artist_images(
+                    cache, data_dir / "artist_images", args.image_workers, args.thumbnail_size
+                ),
+                inputs=[cached("artists"), lambda: args.thumbnail_size],
+                outputs=[data_dir / "artist_images" / MANIFEST_FILE],
+                after=["fetch_artists"],
+            ),
+            Stage(
+                "popularity_history",
+                lambda: save_popularity_history_parquet(cache, popularity_history_parquet),
+                inputs=[cache.popularity_history_count],
+                outputs=[popularity_history_parquet],
+                after=["fetch_tracks", "fetch_albums", "fetch_artists"],
+            ),
+            Stage(
+                "join",
+                lambda: save_listening_history_with_internet_data(
+                    data_dir, output_parquet, partitioned=args.partitioned
+                ),
+                inputs=[
+                    tracks_parquet,
+                    albums_parquet,
+                    artists_parquet,
+                    history_parquet,
+                    lambda: args.partitioned,
+                ],
+                outputs=[output_parquet] + ([output_parquet.with_suffix("")] if args.partitioned else []),
+                after=["tracks_parquet", "albums_parquet", "artists_parquet"],
+            ),
+            Stage(
+                "star_schema",
+                lambda: save_star_schema(data_dir, star_dir),
+                inputs=[tracks_parquet, albums_parquet, artists_parquet, history_parquet],
+                outputs=[star_dir / FACT_FILE],
+                after=["tracks_parquet", "albums_parquet", "artists_parquet"],
+            ),
+        ],
     )
+    # The final listening history is either saved as one wide table or as a star schema
+    selected_stages = args.stages or [
+        name for name in pipeline.names if name != ("join" if args.star_schema else "star_schema")
+    ]
+    unknown_stages = set(args.stages or []) - set(pipeline.names)
+    if unknown_stages:
+        parser.error(f"unknown stages {sorted(unknown_stages)}, see --list-stages")
+    if args.list_stages:
+        print("\n".join(pipeline.names))
+    else:
+        pipeline.run(selected_stages, force=args.force or args.rebuild, workers=args.stage_workers)
+    cache.close()
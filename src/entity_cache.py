@@ -0,0 +1,365 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from tqdm import tqdm
+
+# Number of rows per query when reading or writing many entities
+CHUNK_SIZE = 1000
+
+# Kinds of entities with a popularity that changes over time, every fetch of them is kept as a snapshot
+POPULARITY_KINDS = ("tracks", "artists", "albums")
+
+# Seconds until ids that couldn't be resolved (see EntityCache.put_unresolved) are looked up again
+NEGATIVE_TTL = 30 * 24 * 60 * 60
+
+
+class EntityCache:
+    """
+    Single file SQLite cache of the raw JSON data fetched from the Spotify API and Wikidata.
+
+    Every entity is stored once per kind ("tracks", "artists", "albums", "artist_wikidata") as zlib
+    compressed JSON together with the time it was fetched. Finding the uncached ids of a list of ids
+    and reading all entities of a kind are single queries instead of one file system call per id.
+    The cache can be shared by multiple threads.
+
+    The popularity (and the followers of artists) of every fetched track, artist and album is also
+    added to an append-only history, so refetching an entity keeps its previous values.
+
+    Ids that can't be resolved (e.g. tracks removed from Spotify or artists without a Wikidata
+    item) are kept with a reason for negative_ttl seconds, missing_ids skips them until then.
+    """
+
+    def __init__(self, path, negative_ttl=NEGATIVE_TTL):
+        self.path = Path(path)
+        self.negative_ttl = negative_ttl
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entities (
+                kind TEXT NOT NULL,
+                id TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (kind, id)
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS entities_fetched_at ON entities (kind, fetched_at)"
+        )
+        new_history = not self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'popularity_history'"
+        ).fetchone()
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS popularity_history (
+                kind TEXT NOT NULL,
+                id TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                popularity INTEGER,
+                followers INTEGER,
+                PRIMARY KEY (kind, id, fetched_at)
+            )
+            """
+        )
+        new_unresolved = not self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'unresolved'"
+        ).fetchone()
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS unresolved (
+                kind TEXT NOT NULL,
+                id TEXT NOT NULL,
+                checked_at REAL NOT NULL,
+                reason TEXT NOT NULL,
+                PRIMARY KEY (kind, id)
+            )
+            """
+        )
+        self.connection.commit()
+        if new_history:
+            self.backfill_popularity_history()
+        if new_unresolved:
+            self.move_empty_wikidata_to_unresolved()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def put_many(self, kind, items):
+        """Save (id, data) pairs fetched now, existing entities are replaced."""
+        fetched_at = time.time()
+        self.put_rows(kind, [(entity_id, data, fetched_at) for entity_id, data in items])
+
+    def put_rows(self, kind, rows):
+        """Save (id, data, fetched_at) rows, existing entities are replaced."""
+        snapshots = popularity_snapshots(kind, rows)
+        rows = [(kind, entity_id, fetched_at, encode(data)) for entity_id, data, fetched_at in rows]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)", rows)
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO popularity_history VALUES (?, ?, ?, ?, ?)", snapshots
+            )
+            self.connection.executemany(
+                "DELETE FROM unresolved WHERE kind = ? AND id = ?", (row[:2] for row in rows)
+            )
+
+    def put_unresolved(self, kind, ids, reason):
+        """
+        Save ids that couldn't be resolved now, so they are not looked up again for negative_ttl seconds.
+
+        Args:
+            kind: Kind of the entities, e.g. "tracks"
+            ids: Ids that couldn't be resolved
+            reason: Why, e.g. "spotify_null" if Spotify returned no data for the id or
+                "not_in_wikidata" if no Wikidata item has the Spotify id
+        """
+        checked_at = time.time()
+        self.put_unresolved_rows(kind, [(entity_id, checked_at) for entity_id in ids], reason)
+
+    def put_unresolved_rows(self, kind, rows, reason):
+        """Save (id, checked_at) rows of ids that couldn't be resolved at checked_at, see put_unresolved."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO unresolved VALUES (?, ?, ?, ?)",
+                ((kind, entity_id, checked_at, reason) for entity_id, checked_at in rows),
+            )
+
+    def expired_unresolved_count(self, kind):
+        """Return the number of unresolved ids of a kind that expired and are looked up again."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM unresolved WHERE kind = ? AND checked_at < ?",
+                (kind, self.negative_cutoff()),
+            ).fetchone()[0]
+
+    def unresolved_counts(self, kind):
+        """Return {reason: number of ids} of the unresolved ids of a kind that are not expired."""
+        with self.lock:
+            return dict(
+                self.connection.execute(
+                    "SELECT reason, COUNT(*) FROM unresolved WHERE kind = ? AND checked_at >= ? GROUP BY reason",
+                    (kind, self.negative_cutoff()),
+                ).fetchall()
+            )
+
+    def negative_cutoff(self):
+        """Return the time unresolved ids have to be checked after to still be skipped."""
+        return 0 if self.negative_ttl is None else time.time() - self.negative_ttl
+
+    def move_empty_wikidata_to_unresolved(self):
+        """Replace the empty Wikidata results cached by older versions with unresolved ids."""
+        for rows in self.iter_raw_chunks("artist_wikidata", columns="id, data, fetched_at"):
+            empty = [
+                (entity_id, fetched_at)
+                for entity_id, data, fetched_at in rows
+                if is_empty_wikidata(decode(data))
+            ]
+            self.put_unresolved_rows("artist_wikidata", empty, "not_in_wikidata")
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    "DELETE FROM entities WHERE kind = 'artist_wikidata' AND id = ?",
+                    ((entity_id,) for entity_id, _ in empty),
+                )
+
+    def backfill_popularity_history(self):
+        """Add the cached entities of caches created before the popularity history to it."""
+        for kind in POPULARITY_KINDS:
+            for rows in self.iter_raw_chunks(kind, columns="id, data, fetched_at"):
+                snapshots = popularity_snapshots(
+                    kind, [(entity_id, decode(data), fetched_at) for entity_id, data, fetched_at in rows]
+                )
+                with self.lock, self.connection:
+                    self.connection.executemany(
+                        "INSERT OR IGNORE INTO popularity_history VALUES (?, ?, ?, ?, ?)", snapshots
+                    )
+
+    def popularity_history(self):
+        """Return all popularity snapshots as (kind, id, fetched_at, popularity, followers) rows."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT * FROM popularity_history ORDER BY kind, id, fetched_at"
+            ).fetchall()
+
+    def popularity_history_count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM popularity_history").fetchone()[0]
+
+    def get(self, kind, entity_id):
+        """Return the data of an entity or None if it isn't cached."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM entities WHERE kind = ? AND id = ?", (kind, entity_id)
+            ).fetchone()
+        return decode(row[0]) if row else None
+
+    def get_many(self, kind):
+        """Yield (id, data) of all entities of a kind, reading CHUNK_SIZE entities per query."""
+        for rows in self.iter_raw_chunks(kind):
+            for entity_id, data in rows:
+                yield entity_id, decode(data)
+
+    def iter_raw_chunks(self, kind, since=None, columns="id, data"):
+        """
+        Yield lists of up to CHUNK_SIZE (id, compressed data) rows of all entities of a kind, see decode.
+
+        With `since`, only the entities fetched after that time are read. `columns` selects other
+        columns of the rows, the first one has to be the id.
+        """
+        last_id = ""
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT {columns} FROM entities WHERE kind = ? AND id > ? AND fetched_at > ? ORDER BY id LIMIT ?",
+                    (kind, last_id, since or 0, CHUNK_SIZE),
+                ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def get_raw(self, kind, ids):
+        """Return {id: compressed data} of the cached entities of a kind among `ids`, see decode."""
+        ids = list(ids)
+        result = {}
+        for i in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[i : i + CHUNK_SIZE]
+            with self.lock:
+                result.update(
+                    self.connection.execute(
+                        f"SELECT id, data FROM entities WHERE kind = ? AND id IN ({','.join('?' * len(chunk))})",
+                        (kind, *chunk),
+                    ).fetchall()
+                )
+        return result
+
+    def ids(self, kind, since=None):
+        """Return the ids of all cached entities of a kind, or of the ones fetched after `since`."""
+        with self.lock:
+            return [
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT id FROM entities WHERE kind = ? AND fetched_at > ?", (kind, since or 0)
+                )
+            ]
+
+    def count(self, kind, since=None, fetched_before=None):
+        """Return the number of cached entities of a kind, optionally only the ones fetched in a time range."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM entities WHERE kind = ? AND fetched_at > ? AND fetched_at < ?",
+                (kind, since or 0, fetched_before or float("inf")),
+            ).fetchone()[0]
+
+    def last_fetched_at(self, kind):
+        """Return the time the last entity of a kind was fetched, 0 if there are none."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COALESCE(MAX(fetched_at), 0) FROM entities WHERE kind = ?", (kind,)
+            ).fetchone()[0]
+
+    def missing_ids(self, kind, ids, fetched_before=None):
+        """
+        Return the ids that are not cached yet, in the order of `ids`.
+
+        With `fetched_before`, the ids of entities fetched before that time are returned as well, so
+        they can be fetched again. Unresolved ids are not returned until they expire.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (id TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM wanted")
+            self.connection.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((i,) for i in ids))
+            missing = {
+                row[0]
+                for row in self.connection.execute(
+                    """
+                    SELECT wanted.id FROM wanted
+                    LEFT JOIN entities ON entities.kind = ? AND entities.id = wanted.id
+                    LEFT JOIN unresolved ON unresolved.kind = ? AND unresolved.id = wanted.id
+                        AND unresolved.checked_at >= ?
+                    WHERE (entities.id IS NULL OR entities.fetched_at < ?) AND unresolved.id IS NULL
+                    """,
+                    (kind, kind, self.negative_cutoff(), fetched_before or 0),
+                )
+            }
+        return [i for i in ids if i in missing]
+
+
+def popularity_snapshots(kind, rows):
+    """Return the popularity_history rows of (id, data, fetched_at) rows of a kind."""
+    if kind not in POPULARITY_KINDS:
+        return []
+    return [
+        (kind, entity_id, fetched_at, data.get("popularity"), (data.get("followers") or {}).get("total"))
+        for entity_id, data, fetched_at in rows
+        if data
+    ]
+
+
+def is_empty_wikidata(data):
+    """Check if a cached Wikidata result has no results, older versions cached them for every miss."""
+    return not (data or {}).get("results", {}).get("bindings")
+
+
+def encode(data):
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+
+
+def decode(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+def import_json_dir(cache, kind, json_dir):
+    """
+    Import a directory with one JSON file per entity (the previous cache format) into the cache.
+
+    Empty Wikidata results are imported as unresolved ids, checked when the file was written.
+    """
+    files = list(Path(json_dir).glob("*.json"))
+    for i in tqdm(range(0, len(files), CHUNK_SIZE), desc=f"Importing {kind}"):
+        rows = []
+        unresolved = []
+        for json_file in files[i : i + CHUNK_SIZE]:
+            with open(json_file) as f:
+                data = json.load(f)
+            if kind == "artist_wikidata" and is_empty_wikidata(data):
+                unresolved.append((json_file.stem, json_file.stat().st_mtime))
+            elif data is not None:
+                rows.append((json_file.stem, data, json_file.stat().st_mtime))
+        cache.put_rows(kind, rows)
+        cache.put_unresolved_rows(kind, unresolved, "not_in_wikidata")
+
+
+def import_json_cache(cache, data_dir):
+    """Import the JSON file directories of the previous cache format from data_dir, if they exist."""
+    json_dirs = {
+        "tracks": data_dir / "spotify_data" / "tracks",
+        "artists": data_dir / "spotify_data" / "artists",
+        "albums": data_dir / "spotify_data" / "albums",
+        "artist_wikidata": data_dir / "artist_wikidata",
+    }
+    for kind, json_dir in json_dirs.items():
+        if json_dir.exists():
+            import_json_dir(cache, kind, json_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import the JSON file cache of older versions into the cache file"
+    )
+    parser.add_argument("data_dir", type=str, nargs="?", default="data", help="Path to the data directory")
+    args = parser.parse_args()
+
+    data_dir = Path(args.data_dir)
+    cache = EntityCache(data_dir / "entity_cache.sqlite")
+    import_json_cache(cache, data_dir)
+    cache.close()
+    print(f"Imported JSON cache into {cache.path}")
@@ -0,0 +1,173 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from tqdm import tqdm
+
+from pipeline import stop_requested
+from util import http_get, save_json
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Manifest of an images directory with the source url of every downloaded image
+MANIFEST_FILE = "manifest.json"
+
+# Url of the images of directories of older versions without a manifest, the source is not known
+UNKNOWN_URL = "unknown"
+
+# Size of the chunks the images are streamed to disk with
+CHUNK_BYTES = 64 * 1024
+
+# The manifest is saved after this many finished downloads, so an interrupted run keeps most of its work
+MANIFEST_SAVE_INTERVAL = 200
+
+
+def select_image_url(images, thumbnail_size=None):
+    """
+    Return the url of the image to download from a Spotify images list, or None if there is none.
+
+    Spotify offers every image in a few sizes (e.g. 640, 300 and 64 pixels). Without a thumbnail_size
+    the first (largest) image is used, otherwise the smallest one that is still at least
+    thumbnail_size pixels wide.
+    """
+    images = [image for image in images or [] if image.get("url")]
+    if not images:
+        return None
+    if thumbnail_size is None:
+        return images[0]["url"]
+    large_enough = [image for image in images if (image.get("width") or 0) >= thumbnail_size]
+    if not large_enough:
+        return images[0]["url"]
+    return min(large_enough, key=lambda image: image["width"])["url"]
+
+
+def download_image(url, output_path, thumbnail_size=None):
+    """
+    Stream an image to output_path, optionally downscaled to fit into thumbnail_size pixels.
+
+    The image is written to a temporary file next to output_path and renamed when it is complete,
+    so an interrupted download never leaves a truncated image behind.
+    """
+    part_path = output_path.with_name(f"{output_path.name}.{threading.get_ident()}.part")
+    try:
+        with http_get(url, stream=True) as image_response:
+            image_response.raise_for_status()
+            with open(part_path, "wb") as img_file:
+                for chunk in image_response.iter_content(CHUNK_BYTES):
+                    img_file.write(chunk)
+
+        if thumbnail_size is not None:
+            resize_image(part_path, thumbnail_size)
+        os.replace(part_path, output_path)
+        return True
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"Error downloading image: {e}")
+        part_path.unlink(missing_ok=True)
+        return False
+
+
+def resize_image(image_path, thumbnail_size):
+    """Downscale an image in place to fit into thumbnail_size x thumbnail_size pixels and save it as JPEG."""
+    with Image.open(image_path) as image:
+        if max(image.size) <= thumbnail_size:
+            return
+        image.thumbnail((thumbnail_size, thumbnail_size))
+        image.convert("RGB").save(image_path, "JPEG", quality=85, optimize=True)
+
+
+def load_manifest(images_path):
+    """
+    Load the manifest of an images directory.
+
+    Directories of older versions have no manifest, their existing images are added to a new one
+    with UNKNOWN_URL as url.
+
+    Returns:
+        dict: {id: {"url": image url, UNKNOWN_URL or None if there is no image,
+            "thumbnail_size": size the image was downscaled to or None}}
+    """
+    manifest_file = images_path / MANIFEST_FILE
+    if manifest_file.exists():
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        # Manifests of earlier versions saved the images of older versions with None as url
+        for entity_id, entry in manifest.items():
+            if entry["url"] is None and (images_path / f"{entity_id}.jpg").exists():
+                entry["url"] = UNKNOWN_URL
+        return manifest
+    return {f.stem: {"url": UNKNOWN_URL, "thumbnail_size": None} for f in images_path.glob("*.jpg")}
+
+
+def save_manifest(images_path, manifest):
+    save_json(images_path / MANIFEST_FILE, manifest)
+
+
+def download_images(images_by_id, images_path, desc, workers=16, thumbnail_size=None):
+    """
+    Download one image per id to images_path/<id>.jpg with a thread pool.
+
+    Ids that are in the manifest are skipped, unless their image url or the size they are downscaled
+    to changed, so images downloaded without Pillow are downscaled once it is installed. Ids without
+    an image are added to the manifest as well, so they are only looked at again if they get one.
+    Images of older versions with an unknown url are kept, unless a thumbnail_size is used. Failed
+    downloads are not added and retried in the next run.
+
+    Args:
+        images_by_id: Iterable of (id, Spotify images list) pairs
+        images_path: Directory to save the images and the manifest to
+        desc: Description of the progress bar
+        workers: Maximum number of concurrent downloads
+        thumbnail_size: Download the smallest image size that is at least this many pixels wide and
+            downscale it to fit into thumbnail_size pixels if Pillow is installed
+
+    Returns:
+        bool: True if all images were downloaded
+    """
+    resize_size = thumbnail_size
+    if thumbnail_size is not None and Image is None:
+        print("Pillow is not installed, images are downloaded in the closest size Spotify offers")
+        resize_size = None
+    images_path.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(images_path)
+
+    to_download = {}
+    for entity_id, images in images_by_id:
+        url = select_image_url(images, thumbnail_size)
+        entry = manifest.get(entity_id)
+        if entry is not None and (
+            (entry["url"] == UNKNOWN_URL and thumbnail_size is None)
+            or (entry["url"] == url and (url is None or entry["thumbnail_size"] == resize_size))
+        ):
+            continue
+        if url is None:
+            manifest[entity_id] = {"url": None, "thumbnail_size": None}
+        else:
+            to_download[entity_id] = url
+
+    complete = True
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(download_image, url, images_path / f"{entity_id}.jpg", resize_size): entity_id
+            for entity_id, url in to_download.items()
+        }
+        for i, future in enumerate(tqdm(as_completed(futures), total=len(futures), desc=desc)):
+            entity_id = futures[future]
+            if future.result():
+                manifest[entity_id] = {"url": to_download[entity_id], "thumbnail_size": resize_size}
+            else:
+                print(f"Failed to download image for {entity_id}")
+                complete = False
+            if (i + 1) % MANIFEST_SAVE_INTERVAL == 0:
+                save_manifest(images_path, manifest)
+            if stop_requested.is_set():
+                # The pipeline was interrupted, the images that didn't start are left for the next run
+                pool.shutdown(cancel_futures=True)
+                complete = False
+                break
+    save_manifest(images_path, manifest)
+    return complete
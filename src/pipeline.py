@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from util import save_json
+
+# Set when a pipeline run is interrupted (e.g. Ctrl-C), long running stages check it between batches
+# and return early, so the process doesn't have to wait until they finished
+stop_requested = threading.Event()
+
+
+class Stage:
+    """
+    A step of a pipeline with the inputs it depends on and the files it creates.
+
+    Args:
+        name: Name of the stage, used to select it and to save its state
+        run: Function without arguments that runs the stage. Returning False marks the run as
+            incomplete (e.g. some requests failed), so the stage runs again next time.
+        inputs: Files or functions returning a JSON serializable fingerprint (e.g. the number of cached
+            entities) the result of the stage depends on
+        outputs: Files the stage creates, the stage runs again if one of them is missing
+        after: Names of the stages that have to finish before this stage
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), after=()):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = [Path(output) for output in outputs]
+        self.after = list(after)
+
+    def fingerprint(self):
+        return [input_() if callable(input_) else file_fingerprint(input_) for input_ in self.inputs]
+
+
+def file_fingerprint(path):
+    """Return [name, size, modification time] of a file, or [name, None, None] if it doesn't exist."""
+    path = Path(path)
+    if not path.exists():
+        return [path.name, None, None]
+    stat = path.stat()
+    return [path.name, stat.st_size, stat.st_mtime_ns]
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order and skips the ones whose inputs didn't change since their last
+    complete run.
+
+    The fingerprint of the inputs of every completed stage is saved to state_file right after the
+    stage finished, so after a crash a rerun continues with the stage that didn't finish.
+    """
+
+    def __init__(self, state_file, stages):
+        self.state_file = Path(state_file)
+        self.stages = list(stages)
+        names = set()
+        for stage in self.stages:
+            missing = [name for name in stage.after if name not in names]
+            if missing:
+                raise ValueError(f"Stage {stage.name} runs after unknown or later stages: {missing}")
+            names.add(stage.name)
+
+    @property
+    def names(self):
+        return [stage.name for stage in self.stages]
+
+    def load_state(self):
+        if not self.state_file.exists():
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        save_json(self.state_file, state, indent=2)
+
+    def is_fresh(self, stage, fingerprint, state):
+        """Check if a stage completed with the same inputs before and its outputs still exist."""
+        return state.get(stage.name, {}).get("inputs") == fingerprint and all(
+            output.exists() for output in stage.outputs
+        )
+
+    def run(self, selected=None, force=False, workers=1):
+        """
+        Run the stale stages, up to `workers` stages at once.
+
+        A stage starts as soon as all selected stages it runs after have finished, so independent
+        stages run concurrently. If a stage fails, the running stages are finished, no new ones are
+        started and the error is raised. On Ctrl-C the stages that didn't start yet are cancelled and
+        stop_requested is set, so the running stages stop after their current batch.
+
+        Args:
+            selected: Names of the stages to consider, all if None
+            force: Run the stages even if their inputs didn't change
+            workers: Maximum number of stages running at the same time
+        """
+        unknown = set(selected or []) - set(self.names)
+        if unknown:
+            raise ValueError(f"Unknown stages: {sorted(unknown)}, available stages: {self.names}")
+
+        state = self.load_state()
+        pending = [stage for stage in self.stages if selected is None or stage.name in selected]
+        pending_names = {stage.name for stage in pending}
+        finished = set()
+        running = {}
+        error = None
+        stop_requested.clear()
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while pending or running:
+                ready = [
+                    stage
+                    for stage in pending
+                    if error is None
+                    and all(name in finished or name not in pending_names for name in stage.after)
+                ]
+                for stage in ready:
+                    pending.remove(stage)
+                    fingerprint = stage.fingerprint()
+                    if not force and self.is_fresh(stage, fingerprint, state):
+                        print(f"Skipping stage {stage.name}, its inputs didn't change")
+                        finished.add(stage.name)
+                    else:
+                        print(f"Running stage {stage.name}")
+                        running[pool.submit(stage.run)] = (stage, fingerprint)
+                if not running:
+                    if error is not None or not ready:
+                        break
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, fingerprint = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Stage {stage.name} failed: {e}")
+                        error = error or e
+                        continue
+                    finished.add(stage.name)
+                    if result is False:
+                        print(f"Stage {stage.name} did not complete, it runs again next time")
+                        continue
+                    state[stage.name] = {"inputs": fingerprint, "finished_at": time.time()}
+                    self.save_state(state)
+        except BaseException:
+            print("Stopping the running stages after their current batch")
+            stop_requested.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+
+        if error is not None:
+            raise error
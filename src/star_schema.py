@@ -0,0 +1,165 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from storage import CATEGORICAL_COLUMNS, encode_history, load_dictionaries, save_dictionaries
+
+# Files of the star schema, the fact table has one row per play and int32 keys into the dimensions
+FACT_FILE = "plays.parquet"
+DIMENSION_FILES = {
+    "track_key": "tracks.parquet",
+    "album_key": "albums.parquet",
+    "artist_key": "artists.parquet",
+}
+
+
+def dimension_keys(ids, index):
+    """Return the int32 keys of ids in a {id: key} index, -1 for missing ids."""
+    return pd.Series(ids).map(index).fillna(-1).to_numpy(np.int32)
+
+
+def save_star_schema(data_dir, star_dir):
+    """
+    Save the listening history with the tracks, albums and artists as a star schema.
+
+    The fact table contains the plays with a track_key, album_key and artist_key and the dictionary
+    encoded columns of the compact schema. Every track, album and artist is saved once in its
+    dimension table, where the key is the row number. The artist_id of the plays and the album_id
+    of the tracks are kept as well, for artists and albums that are not in the dimension tables
+    (e.g. because they couldn't be fetched yet). Track keys are the ones of
+    data_dir/track_keys.parquet, so they stay the same across runs and match the compact listening
+    history. Use read_star_schema to load it with the columns of the wide listening history.
+
+    Args:
+        data_dir: Directory with listening_history.parquet, tracks.parquet, albums.parquet and artists.parquet
+        star_dir: Directory to save the fact and dimension tables to
+    """
+    data_dir, star_dir = Path(data_dir), Path(star_dir)
+    star_dir.mkdir(parents=True, exist_ok=True)
+
+    history = pd.read_parquet(data_dir / "listening_history.parquet")
+    history = history.astype({col: "string" for col in ["track_id", "artist_id", *CATEGORICAL_COLUMNS]})
+    tracks = pd.read_parquet(data_dir / "tracks.parquet")
+    albums = pd.read_parquet(data_dir / "albums.parquet")
+    artists = pd.read_parquet(data_dir / "artists.parquet")
+
+    dictionaries, track_ids = load_dictionaries(data_dir)
+    fact = encode_history(history, dictionaries, track_ids)
+    known_track_ids = set(track_ids)
+    track_ids += [track_id for track_id in tracks["track_id"] if track_id not in known_track_ids]
+    save_dictionaries(data_dir, dictionaries, track_ids)
+
+    album_index = {album_id: key for key, album_id in enumerate(albums["album_id"])}
+    artist_index = {artist_id: key for key, artist_id in enumerate(artists["artist_id"])}
+
+    # One row per track_key, tracks of the history that couldn't be fetched have no data
+    dim_tracks = pd.DataFrame({"track_id": pd.Series(track_ids, dtype="string")}).merge(
+        tracks, on="track_id", how="left"
+    )
+    dim_tracks["album_key"] = dimension_keys(dim_tracks["album_id"], album_index)
+
+    track_album_keys = dim_tracks["album_key"].to_numpy()
+    fact["album_key"] = np.where(fact["track_key"] >= 0, track_album_keys[fact["track_key"]], -1)
+    fact["artist_key"] = dimension_keys(fact["artist_id"], artist_index)
+    fact["artist_id"] = fact["artist_id"].astype("category")
+
+    fact.to_parquet(star_dir / FACT_FILE, index=False)
+    dim_tracks.to_parquet(star_dir / DIMENSION_FILES["track_key"], index=False)
+    albums.to_parquet(star_dir / DIMENSION_FILES["album_key"], index=False)
+    artists.to_parquet(star_dir / DIMENSION_FILES["artist_key"], index=False)
+    print(f"Created star schema in {star_dir}")
+
+
+def take_by_key(values, keys):
+    """
+    Return the values of a dimension column for every key of the fact table, NA for the key -1.
+
+    String columns are returned as categoricals, so a value is stored once and not once per play.
+    Other columns are returned with a nullable dtype.
+    """
+    keys = np.asarray(keys)
+    if pd.api.types.is_string_dtype(values):
+        codes, categories = pd.factorize(values)
+        return pd.Categorical.from_codes(
+            np.where(keys >= 0, codes[keys], -1), categories=categories.astype("string")
+        )
+    return values.convert_dtypes().array.take(keys, allow_fill=True)
+
+
+def read_star_schema(star_dir, columns=None, filters=None):
+    """
+    Read the plays of a star schema with the columns of listening_history_with_internet_data.parquet.
+
+    Only the requested columns are read, and only the dimensions they come from are joined. The
+    join looks up the values by the int32 keys of the fact table instead of merging on the ids.
+    Without columns, all columns are returned in the order of the wide table.
+
+    Args:
+        star_dir: Directory written by save_star_schema
+        columns: Columns to return, e.g. ["ts", "artist_name", "hours_played"], all if None
+        filters: Row filters on the columns of the fact table passed to pd.read_parquet,
+            e.g. [("ts", ">=", pd.Timestamp("2021-01-01"))]
+
+    Returns:
+        pd.DataFrame: One row per play
+    """
+    star_dir = Path(star_dir)
+    history_columns = [
+        "track_id" if name == "track_key" else name
+        for name in pq.read_schema(star_dir / FACT_FILE).names
+        if name not in ("album_key", "artist_key")
+    ]
+    dimension_columns = {
+        key: [name for name in pq.read_schema(star_dir / file).names if name not in DIMENSION_FILES]
+        for key, file in DIMENSION_FILES.items()
+    }
+    # Every column is read from the first table that has it, the same as in the wide table
+    source_of = {col: "fact" for col in history_columns if col != "track_id"}
+    for key, cols in dimension_columns.items():
+        for col in cols:
+            source_of.setdefault(col, key)
+    source_of["hours_played"] = "fact"
+    wide_columns = [*history_columns, *(col for col in source_of if col not in history_columns)]
+
+    if columns is None:
+        columns = wide_columns
+    unknown = [col for col in columns if col not in source_of]
+    if unknown:
+        raise ValueError(f"Unknown columns: {unknown}")
+
+    wanted = {
+        source: [col for col in columns if source_of[col] == source] for source in ["fact", *DIMENSION_FILES]
+    }
+    read_fact = [col for col in wanted["fact"] if col != "hours_played"]
+    if "hours_played" in columns and "ms_played" not in read_fact:
+        read_fact.append("ms_played")
+    fact = pd.read_parquet(
+        star_dir / FACT_FILE,
+        columns=read_fact + [key for key in DIMENSION_FILES if wanted[key]],
+        filters=filters,
+    )
+
+    df = pd.DataFrame(index=fact.index)
+    for col in wanted["fact"]:
+        if col == "hours_played":
+            df[col] = fact["ms_played"] / (1000 * 60 * 60)
+        else:
+            df[col] = fact[col]
+    for key, file in DIMENSION_FILES.items():
+        if wanted[key]:
+            dimension = pd.read_parquet(star_dir / file, columns=wanted[key])
+            for col in wanted[key]:
+                df[col] = take_by_key(dimension[col], fact[key])
+    return df[columns]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Save the enriched listening history as a star schema")
+    parser.add_argument("data_dir", type=str, nargs="?", default="data", help="Path to the data directory")
+    args = parser.parse_args()
+
+    data_dir = Path(args.data_dir)
+    save_star_schema(data_dir, data_dir / "star")
@@ -0,0 +1,257 @@
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Low cardinality columns of the listening history that are stored as dictionary encoded columns
+CATEGORICAL_COLUMNS = ["reason_start", "reason_end", "conn_country", "platform"]
+
+# Rows per row group of the year partitioned datasets. A year of listening is a few tens of thousands
+# of plays, so a year has a few row groups and ts filters within a year can skip some of them.
+PARTITION_ROW_GROUP_ROWS = 8192
+
+# Side tables of the compact schema, saved next to the listening history parquet files
+DICTIONARIES_FILE = "history_dictionaries.json"
+TRACK_KEYS_FILE = "track_keys.parquet"
+
+
+def is_compact(parquet_file):
+    """Check if a listening history parquet file uses the compact schema."""
+    return "track_key" in pq.read_schema(parquet_file).names
+
+
+def load_dictionaries(data_dir):
+    """
+    Load the categories of the dictionary encoded columns and the track_id of every track_key.
+
+    Returns:
+        tuple: ({column: [category, ...]}, [track_id, ...]) where the index of a track_id is its key
+    """
+    dictionaries_file = Path(data_dir) / DICTIONARIES_FILE
+    track_keys_file = Path(data_dir) / TRACK_KEYS_FILE
+    dictionaries = {}
+    if dictionaries_file.exists():
+        with open(dictionaries_file) as f:
+            dictionaries = json.load(f)
+    track_ids = []
+    if track_keys_file.exists():
+        track_ids = pd.read_parquet(track_keys_file)["track_id"].tolist()
+    return {col: dictionaries.get(col, []) for col in CATEGORICAL_COLUMNS}, track_ids
+
+
+def save_dictionaries(data_dir, dictionaries, track_ids):
+    with open(Path(data_dir) / DICTIONARIES_FILE, "w") as f:
+        json.dump(dictionaries, f, indent=2)
+    pd.DataFrame(
+        {
+            "track_key": np.arange(len(track_ids), dtype=np.int32),
+            "track_id": pd.Series(track_ids, dtype="string"),
+        }
+    ).to_parquet(Path(data_dir) / TRACK_KEYS_FILE, index=False)
+
+
+def encode_history(df, dictionaries, track_ids):
+    """
+    Convert a listening history DataFrame to the compact schema.
+
+    The dictionaries are only ever appended to, so a value keeps its code across runs and files.
+    New values are added to `dictionaries` and `track_ids` in place.
+
+    Returns:
+        pd.DataFrame: track_id replaced by an int32 track_key, ms_played as int32 and the
+            CATEGORICAL_COLUMNS as categoricals with the stable categories
+    """
+    df = df.copy()
+    for col in CATEGORICAL_COLUMNS:
+        categories = dictionaries[col]
+        known = set(categories)
+        categories += sorted(v for v in df[col].dropna().unique() if v not in known)
+        df[col] = pd.Categorical(df[col], categories=categories)
+
+    track_key_index = {track_id: key for key, track_id in enumerate(track_ids)}
+    for track_id in df["track_id"].dropna().unique():
+        if track_id not in track_key_index:
+            track_key_index[track_id] = len(track_ids)
+            track_ids.append(track_id)
+    track_keys = df["track_id"].map(track_key_index).fillna(-1).astype(np.int32)
+
+    df.insert(df.columns.get_loc("track_id"), "track_key", track_keys)
+    df = df.drop(columns=["track_id"])
+    df["ms_played"] = df["ms_played"].astype(np.int32)
+    return df
+
+
+def decode_history(df, track_ids, plain=False):
+    """
+    Convert a listening history DataFrame from the compact schema back to one with a track_id column.
+
+    Args:
+        df: DataFrame with the compact schema, any subset of its columns
+        track_ids: track_id of every track_key, see load_dictionaries, only needed with a track_key column
+        plain: Return the same dtypes as the non compact schema instead of categoricals
+    """
+    df = df.copy()
+    if "track_key" in df:
+        track_id = pd.Categorical.from_codes(df["track_key"], categories=pd.Index(track_ids, dtype="string"))
+        df.insert(df.columns.get_loc("track_key"), "track_id", track_id)
+        df = df.drop(columns=["track_key"])
+    if plain:
+        if "track_id" in df:
+            df["track_id"] = df["track_id"].astype("string")
+        if "ms_played" in df:
+            df["ms_played"] = df["ms_played"].astype(np.int64)
+        for col in CATEGORICAL_COLUMNS:
+            if col in df:
+                df[col] = df[col].astype("string")
+    return df
+
+
+def read_history(parquet_file, columns=None, filters=None, plain=False):
+    """
+    Read a listening history parquet file, files with the compact schema are decoded.
+
+    With the compact schema the track_id and the CATEGORICAL_COLUMNS are returned as categoricals,
+    which is much faster to load and uses less memory than string columns.
+
+    Args:
+        parquet_file: Listening history parquet file
+        columns: Columns to read, all if None
+        filters: Row filters passed to pd.read_parquet
+        plain: Return the same dtypes as the non compact schema
+    """
+    if not is_compact(parquet_file):
+        return pd.read_parquet(parquet_file, columns=columns, filters=filters)
+
+    read_columns = None
+    if columns is not None:
+        read_columns = ["track_key" if col == "track_id" else col for col in columns]
+    df = pd.read_parquet(parquet_file, columns=read_columns, filters=filters)
+    track_ids = load_dictionaries(Path(parquet_file).parent)[1] if "track_key" in df else None
+    return decode_history(df, track_ids, plain=plain)
+
+
+def iter_history_batches(parquet_file, batch_size):
+    """Yield a listening history parquet file as DataFrames with the non compact schema."""
+    compact = is_compact(parquet_file)
+    if compact:
+        _, track_ids = load_dictionaries(Path(parquet_file).parent)
+    for batch in pq.ParquetFile(parquet_file).iter_batches(batch_size=batch_size):
+        df = batch.to_pandas()
+        yield decode_history(df, track_ids, plain=True) if compact else df
+
+
+def compact_history_file(parquet_file, batch_size=100_000):
+    """
+    Rewrite a listening history parquet file with the compact schema, batch by batch.
+
+    The dictionaries and the track_key side table are saved next to the file and shared by all
+    listening history files in that directory.
+    """
+    parquet_file = Path(parquet_file)
+    data_dir = parquet_file.parent
+    dictionaries, track_ids = load_dictionaries(data_dir)
+    compact_file = parquet_file.with_suffix(".compacting.parquet")
+
+    writer = None
+    for df in iter_history_batches(parquet_file, batch_size):
+        table = pa.Table.from_pandas(encode_history(df, dictionaries, track_ids), preserve_index=False)
+        # Use the same index type for all batches, the number of categories can grow between batches
+        table = table.cast(
+            pa.schema(
+                [
+                    field.with_type(pa.dictionary(pa.int32(), pa.string()))
+                    if field.name in CATEGORICAL_COLUMNS
+                    else field
+                    for field in table.schema
+                ],
+                metadata=table.schema.metadata,
+            )
+        )
+        if writer is None:
+            writer = pq.ParquetWriter(compact_file, table.schema)
+        writer.write_table(table)
+    if writer is None:
+        return
+    writer.close()
+
+    save_dictionaries(data_dir, dictionaries, track_ids)
+    compact_file.replace(parquet_file)
+
+
+def save_partitioned_history(parquet_file, dataset_dir, row_group_size=PARTITION_ROW_GROUP_ROWS):
+    """
+    Save a ts-sorted listening history parquet file as a dataset partitioned by year.
+
+    Every year is saved to `dataset_dir/year=YYYY/part-0.parquet`, sorted by ts and with min/max
+    statistics per row group, so read_history_range only opens the files of the requested years
+    and skips the row groups outside of the requested ts range. The compact schema is kept.
+    """
+    dataset_dir = Path(dataset_dir)
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+
+    writers = {}
+    pending = {}  # rows of a year that don't fill a row group yet
+
+    def write(year):
+        table = pa.concat_tables(pending.pop(year))
+        if year not in writers:
+            (dataset_dir / f"year={year}").mkdir(parents=True)
+            writers[year] = pq.ParquetWriter(
+                dataset_dir / f"year={year}" / "part-0.parquet", table.schema, write_statistics=True
+            )
+        writers[year].write_table(table, row_group_size=row_group_size)
+
+    for batch in pq.ParquetFile(parquet_file).iter_batches(batch_size=row_group_size):
+        years = pc.year(batch.column("ts"))
+        for year in pc.unique(years).to_pylist():
+            pending.setdefault(year, []).append(pa.Table.from_batches([batch.filter(pc.equal(years, year))]))
+            if sum(table.num_rows for table in pending[year]) >= row_group_size:
+                write(year)
+    for year in list(pending):
+        write(year)
+    for writer in writers.values():
+        writer.close()
+    print(f"Saved year partitioned dataset to {dataset_dir}")
+
+
+def read_history_range(dataset_dir, start=None, end=None, columns=None, plain=False):
+    """
+    Read the plays with start <= ts < end from a year partitioned dataset.
+
+    Only the partitions of the years in the range are read and the ts filter is pushed down to the
+    row group statistics. Compact datasets are decoded like in read_history.
+
+    Args:
+        dataset_dir: Directory written by save_partitioned_history
+        start: First timestamp to include (e.g. "2021-01-01"), no lower bound if None
+        end: Timestamp to stop at (exclusive), no upper bound if None
+        columns: Columns to read, all if None
+        plain: Return the same dtypes as the non compact schema
+    """
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning="hive")
+    names = [name for name in dataset.schema.names if name != "year"]
+    compact = "track_key" in names
+
+    if columns is None:
+        columns = ["track_id" if name == "track_key" else name for name in names]
+    read_columns = ["track_key" if compact and col == "track_id" else col for col in columns]
+
+    expression = ds.scalar(True)
+    if start is not None:
+        start = pd.Timestamp(start)
+        expression &= (ds.field("year") >= start.year) & (ds.field("ts") >= start)
+    if end is not None:
+        end = pd.Timestamp(end)
+        expression &= (ds.field("year") <= end.year) & (ds.field("ts") < end)
+
+    df = dataset.to_table(columns=read_columns, filter=expression).to_pandas()
+    if not compact:
+        return df
+    track_ids = load_dictionaries(Path(dataset_dir).parent)[1] if "track_key" in df else None
+    return decode_history(df, track_ids, plain=plain)
@@ -1,16 +1,163 @@
 import base64
+import json
 import os
+import threading
+import time
+from pathlib import Path
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
+try:
+    import fcntl
+except ImportError:  # Windows, the token file is then only shared by the threads of one process
+    fcntl = None
 
-def get_spotify_bearer():
+# Settings of the shared HTTP session, see configure_http
+HTTP_POOL_SIZE = 16  # keep-alive connections per host
+HTTP_TIMEOUT = (10, 30)  # connect and read timeout in seconds
+
+# File the Spotify access token is cached in, shared by all processes using it
+SPOTIFY_TOKEN_FILE = Path(__file__).parent.parent / "data" / "spotify_token.json"
+# Seconds before its expiry the access token is refreshed, so no request is made with an expired token
+SPOTIFY_TOKEN_REFRESH_MARGIN = 300
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def save_json(path, data, indent=None, permissions=0o666):
+    """
+    Save data as JSON to a .part file next to path and replace path with it.
+
+    The replace is atomic, so readers and later runs never see a partly written file, even if the
+    process is interrupted while writing.
+    """
+    path = Path(path)
+    part_file = path.with_name(f"{path.name}.part")
+    with open(os.open(part_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions), "w") as f:
+        json.dump(data, f, indent=indent)
+    part_file.replace(path)
+
+
+def configure_http(pool_size=None, timeout=None):
+    """Change the connection pool size per host and the default timeout of the shared HTTP session."""
+    global HTTP_POOL_SIZE, HTTP_TIMEOUT, _session
+    with _session_lock:
+        if pool_size is not None:
+            HTTP_POOL_SIZE = pool_size
+        if timeout is not None:
+            HTTP_TIMEOUT = timeout
+        _session = None
+
+
+def get_session():
+    """
+    Return the requests session shared by all network calls.
+
+    The session keeps a pool of keep-alive connections per host (api.spotify.com, i.scdn.co,
+    query.wikidata.org, ...), so most requests reuse an open connection instead of doing a new TCP
+    and TLS handshake, and it asks for compressed responses.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            _session = session
+        return _session
+
+
+def http_get(url, **kwargs):
+    """GET request with the shared session and the default timeout."""
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return get_session().get(url, **kwargs)
+
+
+def http_post(url, **kwargs):
+    """POST request with the shared session and the default timeout."""
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return get_session().post(url, **kwargs)
+
+
+class SpotifyToken:
+    """
+    Spotify access token cached on disk and shared by all threads and processes.
+
+    The token and its expiry are saved to token_file. A new token is requested with the refresh
+    token from .env when the cached one expires within refresh_margin seconds, or when the API
+    rejected it (see invalidate). A lock file makes sure only one process requests a new token
+    while the others wait for it and read it from the file.
+    """
+
+    def __init__(self, token_file=SPOTIFY_TOKEN_FILE, refresh_margin=SPOTIFY_TOKEN_REFRESH_MARGIN):
+        self.token_file = Path(token_file)
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0
+
+    def is_valid(self):
+        return self.access_token is not None and time.time() < self.expires_at - self.refresh_margin
+
+    def get(self):
+        """Return a valid access token, requesting a new one if needed."""
+        with self.lock:
+            if not self.is_valid():
+                self.refresh()
+            return self.access_token
+
+    def invalidate(self, access_token):
+        """Mark an access token the API rejected as expired, unless another thread already replaced it."""
+        with self.lock:
+            if self.access_token == access_token:
+                self.expires_at = 0
+                self.refresh(rejected=access_token)
+
+    def refresh(self, rejected=None):
+        """Read the token from the file if another process refreshed it, otherwise request a new one."""
+        self.token_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.token_file.with_name(f"{self.token_file.name}.lock"), "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.load()
+            if self.is_valid() and self.access_token != rejected:
+                return
+            self.access_token, expires_in = request_spotify_token()
+            self.expires_at = time.time() + expires_in
+            self.save()
+
+    def load(self):
+        if not self.token_file.exists():
+            return
+        try:
+            with open(self.token_file) as f:
+                token = json.load(f)
+            self.access_token, self.expires_at = token["access_token"], token["expires_at"]
+        except (ValueError, KeyError):
+            self.access_token, self.expires_at = None, 0
+
+    def save(self):
+        save_json(
+            self.token_file,
+            {"access_token": self.access_token, "expires_at": self.expires_at},
+            permissions=0o600,
+        )
+
+
+spotify_token = SpotifyToken()
+
+
+def request_spotify_token():
     """
-    Get Spotify bearer token using refresh token from .env.
+    Request a new Spotify access token using the refresh token from .env.
 
     Returns:
-        str: The bearer token
+        tuple: (access token, seconds until it expires)
     """
     load_dotenv()
 
@@ -28,7 +175,7 @@ def get_spotify_bearer():
         )
 
     auth_b64 = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-    response = requests.post(
+    response = http_post(
         "https://accounts.spotify.com/api/token",
         data={
             "grant_type": "refresh_token",
@@ -39,7 +186,37 @@ def get_spotify_bearer():
             "Content-Type": "application/x-www-form-urlencoded",
         },
     )
-    return response.json()["access_token"]
+    response.raise_for_status()
+    token = response.json()
+    return token["access_token"], token.get("expires_in", 3600)
+
+
+def get_spotify_bearer():
+    """
+    Get a Spotify bearer token, cached on disk until shortly before it expires.
+
+    Returns:
+        str: The bearer token
+    """
+    return spotify_token.get()
+
+
+def spotify_request(method, url, headers=None, **kwargs):
+    """
+    Request the Spotify API with the cached access token.
+
+    If the API rejects the token (401), e.g. because it was revoked or expired early, the request is
+    retried once with a new token.
+    """
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    for attempt in range(2):
+        access_token = spotify_token.get()
+        response = get_session().request(
+            method, url, headers={**(headers or {}), "Authorization": f"Bearer {access_token}"}, **kwargs
+        )
+        if response.status_code != 401 or attempt == 1:
+            return response
+        spotify_token.invalidate(access_token)
 
 
 def create_spotify_playlist(track_ids: list[str], playlist_name: str) -> str:
@@ -56,18 +233,16 @@ def create_spotify_playlist(track_ids: list[str], playlist_name: str) -> str:
     Raises:
         RuntimeError: If any API request fails
     """
-    headers = {"Authorization": f"Bearer {get_spotify_bearer()}", "Content-Type": "application/json"}
-
     # Get user ID
-    user_response = requests.get("https://api.spotify.com/v1/me", headers=headers)
+    user_response = spotify_request("GET", "https://api.spotify.com/v1/me")
     if not user_response.ok:
         raise RuntimeError(f"Failed to get user info: {user_response.status_code} - {user_response.text}")
     user_id = user_response.json()["id"]
 
     # Create playlist
-    playlist_response = requests.post(
+    playlist_response = spotify_request(
+        "POST",
         f"https://api.spotify.com/v1/users/{user_id}/playlists",
-        headers=headers,
         json={"name": playlist_name, "public": False},
     )
     if not playlist_response.ok:
@@ -80,9 +255,9 @@ def create_spotify_playlist(track_ids: list[str], playlist_name: str) -> str:
     batch_size = 100
     for i in range(0, len(track_ids), batch_size):
         batch = track_ids[i : i + batch_size]
-        tracks_response = requests.post(
+        tracks_response = spotify_request(
+            "POST",
             f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks",
-            headers=headers,
             json={"uris": [f"spotify:track:{track_id}" for track_id in batch]},
         )
         if not tracks_response.ok:
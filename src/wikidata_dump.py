@@ -0,0 +1,143 @@
+import argparse
+import bz2
+import gzip
+import json
+import re
+from pathlib import Path
+
+from tqdm import tqdm
+
+# Wikidata properties used for the artists parquet file and their labels, like in the SPARQL results
+ARTIST_PROPERTIES = {
+    "P31": "instance of",
+    "P21": "sex or gender",
+    "P27": "country of citizenship",
+    "P495": "country of origin",
+    "P569": "date of birth",
+    "P856": "official website",
+    "P136": "genre",
+}
+
+# Entity id of a dump line, it is the second key of every entity
+ENTITY_ID = re.compile(rb'^\{"type":"\w+","id":"(\w+)"')
+
+
+def open_dump(dump_file):
+    """Open a Wikidata JSON dump (.json, .json.gz or .json.bz2) for reading in binary mode."""
+    dump_file = Path(dump_file)
+    if dump_file.suffix == ".bz2":
+        return bz2.open(dump_file, "rb")
+    if dump_file.suffix == ".gz":
+        return gzip.open(dump_file, "rb")
+    return open(dump_file, "rb")
+
+
+def iter_dump_lines(dump_file, desc):
+    """
+    Yield the entity lines of a Wikidata JSON dump without parsing them.
+
+    The dump is one JSON array with one entity per line, so it can be streamed line by line.
+    """
+    with open_dump(dump_file) as f:
+        for line in tqdm(f, desc=desc, unit=" entities"):
+            line = line.strip().rstrip(b",")
+            if line.startswith(b"{"):
+                yield line
+
+
+def entity_label(entity):
+    labels = entity.get("labels", {})
+    if "en" in labels:
+        return labels["en"]["value"]
+    if labels:
+        return next(iter(labels.values()))["value"]
+    return entity["id"]
+
+
+def claim_values(entity, prop):
+    """Return the values of the non deprecated claims of a property, item values as entity ids."""
+    values = []
+    for claim in entity.get("claims", {}).get(prop, []):
+        snak = claim["mainsnak"]
+        if claim.get("rank") == "deprecated" or snak["snaktype"] != "value":
+            continue
+        value = snak["datavalue"]["value"]
+        if isinstance(value, dict):
+            value = value["id"] if "id" in value else value.get("time", "").lstrip("+")
+        values.append(value)
+    return values
+
+
+def read_artist_wikidata(dump_file, spotify_ids):
+    """
+    Read the Wikidata information of artists from a Wikidata JSON dump.
+
+    Only the lines containing a Spotify artist ID claim (P1902) are parsed. The labels of the
+    referenced items (e.g. "human" or a genre) are resolved in the same pass if the item comes
+    after the artist in the dump, the remaining labels with a second pass that only parses the
+    lines of the missing items. Only the artists and the labels are kept in memory.
+
+    Args:
+        dump_file: Wikidata JSON dump, optionally compressed with gzip or bz2
+        spotify_ids: Spotify artist IDs to look up
+
+    Returns:
+        dict: {spotify_id: SPARQL JSON result of that artist} in the format of fetch_artist_wikidata,
+            with no bindings for artists that are not in the dump
+    """
+    spotify_ids = dict.fromkeys(spotify_ids)
+    artists = {}  # spotify_id: (entity_id, [(property, value), ...])
+    labels = {}
+
+    for line in iter_dump_lines(dump_file, "Reading Wikidata dump"):
+        match = ENTITY_ID.match(line)
+        wanted_label = match is not None and labels.get(match.group(1).decode(), "") is None
+        if b'"P1902"' not in line and not wanted_label:
+            continue
+
+        entity = json.loads(line)
+        if wanted_label:
+            labels[entity["id"]] = entity_label(entity)
+        for spotify_id in claim_values(entity, "P1902"):
+            if spotify_id not in spotify_ids:
+                continue
+            claims = [(prop, value) for prop in ARTIST_PROPERTIES for value in claim_values(entity, prop)]
+            artists[spotify_id] = (entity["id"], claims)
+            for _, value in claims:
+                if re.fullmatch(r"Q\d+", value):
+                    labels.setdefault(value, None)
+
+    missing_labels = {entity_id for entity_id, label in labels.items() if label is None}
+    if missing_labels:
+        for line in iter_dump_lines(dump_file, "Resolving Wikidata labels"):
+            match = ENTITY_ID.match(line)
+            if match is not None and match.group(1).decode() in missing_labels:
+                labels[match.group(1).decode()] = entity_label(json.loads(line))
+
+    results = {spotify_id: {"results": {"bindings": []}} for spotify_id in spotify_ids}
+    for spotify_id, (entity_id, claims) in artists.items():
+        results[spotify_id]["results"]["bindings"] = [
+            {
+                "item": {"type": "uri", "value": f"http://www.wikidata.org/entity/{entity_id}"},
+                "propLabel": {"type": "literal", "value": ARTIST_PROPERTIES[prop]},
+                "valueLabel": {"type": "literal", "value": labels.get(value) or value},
+            }
+            for prop, value in claims
+        ]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Print the Wikidata information of artists from a Wikidata dump"
+    )
+    parser.add_argument(
+        "dump_file", type=str, help="Path to the Wikidata JSON dump (.json, .json.gz or .json.bz2)"
+    )
+    parser.add_argument("spotify_ids", type=str, nargs="+", help="Spotify artist IDs")
+    args = parser.parse_args()
+
+    for spotify_id, wikidata in read_artist_wikidata(args.dump_file, args.spotify_ids).items():
+        print(spotify_id)
+        for binding in wikidata["results"]["bindings"]:
+            print(f"  {binding['propLabel']['value']}: {binding['valueLabel']['value']}")
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import json
 import base64
@@ -8,48 +9,92 @@ import numpy as np
 import pandas as pd
 
 
-def read_json(path_or_buf):
-    df = pd.read_json(
-        path_or_buf,
-        dtype={
-            "ts": str,
-            # "username": str,
-            "platform": str,
-            "ms_played": np.int64,
-            "conn_country": str,
-            "ip_addr_decrypted": str,
-            # "user_agent_decrypted": str,
-            "master_metadata_track_name": str,
-            "master_metadata_album_artist_name": str,
-            "master_metadata_album_album_name": str,
-            "spotify_track_uri": str,
-            "episode_name": str,
-            "episode_show_name": str,
-            "spotify_episode_uri": str,
-            "reason_start": str,
-            "reason_end": str,
-            "shuffle": bool,
-            "skipped": bool,
-            "offline": bool,
-            "offline_timestamp": np.int64,
-            "incognito_mode": bool,
-        },
+DTYPES = {
+    "ts": str,
+    # "username": str,
+    "platform": str,
+    "ms_played": np.int64,
+    "conn_country": str,
+    "ip_addr_decrypted": str,
+    # "user_agent_decrypted": str,
+    "master_metadata_track_name": str,
+    "master_metadata_album_artist_name": str,
+    "master_metadata_album_album_name": str,
+    "spotify_track_uri": str,
+    "episode_name": str,
+    "episode_show_name": str,
+    "spotify_episode_uri": str,
+    "reason_start": str,
+    "reason_end": str,
+    "shuffle": bool,
+    "skipped": bool,
+    "offline": bool,
+    "offline_timestamp": np.int64,
+    "incognito_mode": bool,
+}
+
+RENAMES = {
+    "ip_addr_decrypted": "ip_addr",
+    # "user_agent_decrypted": "user_agent",
+    "master_metadata_track_name": "track",
+    "master_metadata_album_artist_name": "artist",
+    "master_metadata_album_album_name": "album",
+}
+
+# columns that identify a play, duplicates are dropped by a hash of these instead of comparing every column
+KEY_COLUMNS = ["ts", "spotify_track_uri", "ms_played", "reason_start", "reason_end", "platform"]
+
+# comma between two records of a pretty printed JSON array (JSON strings can't contain raw newlines)
+RECORD_SEPARATOR = re.compile(rb"\}\s*,[ \t\r]*\n\s*\{")
+
+
+def read_json(path_or_buf, backend="pandas"):
+    if backend == "arrow":
+        try:
+            return read_json_arrow(path_or_buf)
+        except ValueError as e:  # pyarrow.ArrowInvalid is a ValueError
+            print(f"Arrow could not parse {path_or_buf}, falling back to pandas: {e}")
+    df = pd.read_json(path_or_buf, dtype=DTYPES)
+    df = df.rename(columns=RENAMES)
+    return df
+
+
+def read_json_arrow(path):
+    """Read a JSON file with the multithreaded pyarrow JSON reader, pyarrow isn't available on the website."""
+    import pyarrow as pa
+    import pyarrow.json as pa_json
+
+    schema = pa.schema(
+        [
+            (name, {np.int64: pa.int64(), bool: pa.bool_()}.get(dtype, pa.string()))
+            for name, dtype in DTYPES.items()
+        ]
     )
-    df = df.rename(
-        columns={
-            "ip_addr_decrypted": "ip_addr",
-            # "user_agent_decrypted": "user_agent",
-            "master_metadata_track_name": "track",
-            "master_metadata_album_artist_name": "artist",
-            "master_metadata_album_album_name": "album",
-        }
+    with open(path, "rb") as f:
+        data = f.read().strip()
+    if data.startswith(b"["):
+        data = RECORD_SEPARATOR.sub(b"}\n{", data[1:-1].strip())
+    if not data:
+        return schema.empty_table().to_pandas().rename(columns=RENAMES)
+    table = pa_json.read_json(
+        pa.BufferReader(data),
+        read_options=pa_json.ReadOptions(use_threads=True),
+        parse_options=pa_json.ParseOptions(
+            explicit_schema=schema, newlines_in_values=True, unexpected_field_behavior="ignore"
+        ),
     )
+    df = table.to_pandas()
+    # pd.read_json turns missing values of str columns into "None", which preprocess_df relies on
+    for name, dtype in DTYPES.items():
+        if dtype is str:
+            df[name] = df[name].astype(str)
+    df = df.rename(columns=RENAMES)
     return df
 
 
 def preprocess_df(df):
     df = df[df["track"] != "None"]
-    df = df.drop_duplicates()
+    df = df[~pd.util.hash_pandas_object(df[KEY_COLUMNS], index=False).duplicated()]
 
     df["ts"] = pd.to_datetime(df["ts"], format="%Y-%m-%dT%H:%M:%SZ")
     df.loc[df["offline_timestamp"] > 2000000000, "offline_timestamp"] /= 1000
@@ -669,7 +714,14 @@ def main():
         df = pd.read_csv("df.csv", parse_dates=["ts"])
     else:
         dir_path = sys.argv[1]
-        df = pd.concat([read_json(os.path.join(dir_path, fn)) for fn in os.listdir(dir_path) if fn.endswith(".json")])
+        backend = sys.argv[2] if len(sys.argv) > 2 else "pandas"  # "arrow" for the faster pyarrow reader
+        df = pd.concat(
+            [
+                read_json(os.path.join(dir_path, fn), backend)
+                for fn in os.listdir(dir_path)
+                if fn.endswith(".json")
+            ]
+        )
         df = preprocess_df(df)
 
     if only_save_df_csv: